@@ -0,0 +1,111 @@
+"""
+Cold-start benchmark: import-to-first-response time of every handler.
+
+Each function from `template.yaml` runs in a fresh interpreter with the
+offline stubs installed, so the numbers include module imports, client
+construction and the outbound calls made before and during the first
+invocation (with the simulated latencies from `stubs.LATENCY`).
+
+    python benchmarks/cold_start.py [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+SRC = os.path.join(ROOT, "src")
+TEMPLATE = os.path.join(ROOT, "template.yaml")
+
+
+class Context:
+    function_name = "bench"
+    aws_request_id = "bench"
+
+    def __init__(self, timeout_ms=60000):
+        self.deadline = time.time() + timeout_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.deadline - time.time()) * 1000)
+
+
+def environment():
+    import stubs
+    env = dict(os.environ)
+    env.update({
+        "Stage": stubs.STAGE,
+        "LogLevel": "WARNING",
+        "S3SnowBucket": "snow-attachments-bench",
+        "S3_JSD_BUCKET": "jsd-attachments-bench",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        # Repeated events would be dropped as duplicates otherwise
+        "IdempotencyWindow": "0",
+        "LinkBackend": "memory",
+    })
+    return env
+
+
+def run_child(name):
+    """
+    Measure one cold start in this (fresh) interpreter and print it as JSON.
+    """
+    started = time.perf_counter()
+    sys.path[:0] = [SRC, BENCH_DIR]
+    import importlib
+    import stubs
+    import events
+    stubs.install()
+
+    functions = {fn[0]: fn for fn in events.template_functions(TEMPLATE)}
+    _, handler, trigger = functions[name]
+    module_name, function_name = handler.split(".")
+    module = importlib.import_module(module_name)
+    imported = time.perf_counter()
+    import_calls = dict(stubs.CALLS)
+
+    event = events.event_for(handler, trigger)
+    getattr(module, function_name)(event, Context())
+    first = time.perf_counter()
+
+    # The warm call creates its tickets again instead of finding them linked
+    stubs.reset()
+    getattr(module, function_name)(events.event_for(handler, trigger), Context())
+    warm = time.perf_counter()
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "first_ms": (first - started) * 1000,
+        "warm_ms": (warm - first) * 1000,
+        "import_calls": sum(import_calls.values()),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--child")
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args.child)
+
+    sys.path.insert(0, BENCH_DIR)
+    import events
+    env = environment()
+    print(f"{'function':<26} {'handler':<40} {'import ms':>10} {'first ms':>10} {'warm ms':>9} {'import calls':>13}")
+    for name, handler, _ in events.template_functions(TEMPLATE):
+        runs = []
+        for _ in range(args.repeat):
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", name],
+                env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f"{name:<26} {handler:<40} {median['import_ms']:>10.1f} {median['first_ms']:>10.1f} "
+              f"{median['warm_ms']:>9.1f} {int(median['import_calls']):>13}")
+
+
+if __name__ == "__main__":
+    main()
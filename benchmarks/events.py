@@ -0,0 +1,241 @@
+"""
+Synthetic events for every entry point in `template.yaml`.
+"""
+import json
+import re
+
+import stubs
+from stubs import OBJECTS
+
+SNOW_BUCKET = "snow-attachments-bench"
+JSD_BUCKET = "jsd-attachments-bench"
+
+
+def api_event(method, body=None, path_parameters=None, query=None, resource=None):
+    return {
+        "httpMethod": method,
+        "resource": resource,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps(body) if body is not None else None,
+        "pathParameters": path_parameters or {},
+        "queryStringParameters": query,
+    }
+
+
+def s3_event(bucket, keys):
+    return {
+        "Records": [
+            {"s3": {"bucket": {"name": bucket}, "object": {"key": key, "size": OBJECTS.get(key, 1024)}}}
+            for key in keys
+        ],
+    }
+
+
+def jira_post_event():
+    return api_event("POST", {
+        "key": "FSD-1",
+        "fields": {
+            "priority": {"name": "Severity 2"},
+            "summary": "Payment batch fails",
+            "description": "The nightly payment batch fails with a timeout.",
+        },
+    })
+
+
+def jira_put_event():
+    return api_event("PUT", {
+        "key": "FSD-1",
+        "fields": {
+            "priority": {"name": "Severity 4"},
+            "comment": "Retried, still failing.",
+        },
+    }, path_parameters={"incidentId": "INC0001"})
+
+
+def snow_post_event():
+    return api_event("POST", {
+        "snow_incident_number": "INC0001",
+        "reportedby": "Jane Doe",
+        "priority": "2",
+        "summary": "Payment batch fails",
+        "description": "The nightly payment batch fails with a timeout.",
+    })
+
+
+def snow_put_event():
+    return api_event("PUT", {
+        "summary": "Payment batch fails again",
+        "priority": "2",
+        "status": "In Progress",
+        "comment": "Vendor is looking into it.",
+        "reportedby": "Jane Doe",
+    }, path_parameters={"incidentId": "FSD-1"})
+
+
+def snow_bulk_post_event(count=20):
+    incidents = []
+    for i in range(count):
+        incident = json.loads(snow_post_event()["body"])
+        incident["snow_incident_number"] = f"INC{i:04d}"
+        incidents.append(incident)
+    return api_event("POST", incidents, resource="/FSDIncident/bulk")
+
+
+def snow_bulk_put_event(count=20):
+    incidents = []
+    for i in range(count):
+        incident = json.loads(snow_put_event()["body"])
+        incident["incidentId"] = f"FSD-{i}"
+        incidents.append(incident)
+    return api_event("PUT", incidents, resource="/FSDIncident/bulk")
+
+
+def presign_event():
+    return api_event("GET", query={"issue_key": "FSD-1", "file_name": "screenshot.png"})
+
+
+def presign_batch_event(count=20):
+    return api_event("POST", {
+        "issue_key": "FSD-1",
+        "file_names": [f"file-{index}.bin" for index in range(count)],
+    }, resource="/GenerateUploadURL/batch")
+
+
+def presign_multipart_event(size=5 * 1024 ** 3):
+    return api_event("POST", {
+        "issue_key": "FSD-1",
+        "file_name": "dump.bin",
+        "size": size,
+    }, resource="/GenerateUploadURL/multipart")
+
+
+def presign_complete_event(parts=80):
+    return api_event("POST", {
+        "issue_key": "FSD-1",
+        "file_name": "dump.bin",
+        "upload_id": "upload-1",
+        "parts": [{"part_number": number, "etag": f'"etag-{number}"'} for number in range(1, parts + 1)],
+    }, resource="/GenerateUploadURL/multipart/complete")
+
+
+def jsd_to_s3_event(attachment_sizes=(1024,)):
+    attachments = []
+    for index, size in enumerate(attachment_sizes):
+        attachment_id = str(100 + index)
+        OBJECTS[f"attachment/{attachment_id}"] = size
+        attachments.append({"attachmentId": attachment_id, "fileName": f"file-{index}.bin"})
+    return api_event("POST", {
+        "issueKey": "FSD-1",
+        "customerRefNo": "INC0001",
+        "attachments": attachments,
+    })
+
+
+def jsd_comment_event(comment, attachment_count=300):
+    """
+    Comment webhook on an issue with `attachment_count` attachments, named
+    `file-<n>.bin`; `comment` is the comment body (wiki markup or ADF).
+    """
+    stubs.ISSUE_ATTACHMENTS[:] = [
+        {"id": str(1000 + index), "filename": f"file-{index}.bin"}
+        for index in range(attachment_count)
+    ]
+    for item in stubs.ISSUE_ATTACHMENTS:
+        OBJECTS[f"attachment/{item['id']}"] = 100 * 1024
+    return api_event("POST", {
+        "issueKey": "FSD-1",
+        "customerRefNo": "INC0001",
+        "commentId": "10001",
+        "body": comment,
+    })
+
+
+def adf_comment(*file_names):
+    """
+    ADF comment with a paragraph and one media node per file name.
+    """
+    return {
+        "type": "doc",
+        "version": 1,
+        "content": [
+            {"type": "paragraph", "content": [{"type": "text", "text": "See the attached files."}]},
+            {
+                "type": "mediaGroup",
+                "content": [
+                    {"type": "media", "attrs": {"type": "file", "id": f"uuid-{name}",
+                                                "collection": "", "alt": name}}
+                    for name in file_names
+                ],
+            },
+        ],
+    }
+
+
+def s3_to_jsd_event(attachment_sizes=(1024,), issue_keys=("FSD-1",)):
+    keys = []
+    for index, size in enumerate(attachment_sizes):
+        key = f"{issue_keys[index % len(issue_keys)]}/file-{index}.bin"
+        OBJECTS[key] = size
+        keys.append(key)
+    return s3_event(SNOW_BUCKET, keys)
+
+
+def s3_to_snow_event(attachment_sizes=(1024,), incident_numbers=("INC0001",)):
+    keys = []
+    for index, size in enumerate(attachment_sizes):
+        key = f"{incident_numbers[index % len(incident_numbers)]}/{100 + index}/file-{index}.bin"
+        OBJECTS[key] = size
+        keys.append(key)
+    return s3_event(JSD_BUCKET, keys)
+
+
+def queue_event(messages):
+    return {
+        "Records": [
+            {"messageId": str(index), "body": json.dumps(message)}
+            for index, message in enumerate(messages)
+        ],
+    }
+
+
+def jira_worker_event():
+    return queue_event([
+        {"method": "POST", "incidentId": None, "body": json.loads(jira_post_event()["body"])},
+        {"method": "PUT", "incidentId": "INC0001", "body": json.loads(jira_put_event()["body"])},
+    ])
+
+
+def template_functions(path):
+    """
+    Return `(name, handler, trigger)` for each function in `template.yaml`,
+    where `trigger` is the API method (`get`, `post`, `put`), `s3` or `sqs`.
+    The template uses CloudFormation tags, so it is scanned rather than parsed.
+    """
+    text = open(path).read()
+    functions = []
+    pattern = r"^  (\w+):\n\s+Type: AWS::Serverless::Function\n(.*?)(?=^  \w+:\n|^\S|\Z)"
+    for name, body in re.findall(pattern, text, re.M | re.S):
+        handler = re.search(r"Handler: (\S+)", body).group(1)
+        method = re.search(r"Method: (\w+)", body)
+        if method:
+            trigger = method.group(1).lower()
+        else:
+            trigger = "sqs" if re.search(r"Type: SQS", body) else "s3"
+        functions.append((name, handler, trigger))
+    return functions
+
+
+def event_for(handler, trigger):
+    module = handler.split(".")[0]
+    builders = {
+        ("jira_message_processor", "sqs"): jira_worker_event,
+        ("jira_message_processor", "post"): jira_post_event,
+        ("jira_message_processor", "put"): jira_put_event,
+        ("snow_message_processor", "post"): snow_post_event,
+        ("snow_message_processor", "put"): snow_put_event,
+        ("s3_presigned_url", "get"): presign_event,
+        ("jsd_to_s3", "post"): jsd_to_s3_event,
+        ("s3_to_jsd", "s3"): s3_to_jsd_event,
+        ("s3_to_snow", "s3"): s3_to_snow_event,
+    }
+    return builders[(module, trigger)]()
@@ -0,0 +1,210 @@
+"""
+Microbenchmark of the message processors' field mappings.
+
+Compares the table-driven mappings (`mapping.Mapping`) with the hand-written
+functions they replaced, which are kept below for reference. Both are run on
+the same payloads, their outputs are checked to be identical and the time per
+call is printed.
+
+    python benchmarks/mapping_bench.py [--number N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [os.path.join(ROOT, "src"), BENCH_DIR]
+
+from cold_start import environment  # noqa: E402
+
+os.environ.update(environment())
+
+import stubs  # noqa: E402
+
+stubs.LATENCY.clear()
+stubs.install()
+
+import jira_message_processor  # noqa: E402
+import snow_message_processor  # noqa: E402
+from settings import Parameters  # noqa: E402
+
+
+def legacy_jira_post_mapping(body):
+    fields = body.get("fields", {})
+    impact = "3 - Medium"
+    urgency = "3 - Medium"
+    if fields.get("priority", {}).get("name") in ("Severity 4", "Severity 5"):
+        urgency = "4 - Low"
+    incident = {
+        "callingSystem": "FINEOS-SERVICE-DESK",
+        "state": "Active",
+        "reportedSource": "FINEOS",
+        "category": "Application",
+        "subCategory": "Failure",
+        "configurationItem": "11835",
+        "impact": impact,
+        "urgency": urgency,
+        "contactType": "Vendor referral",
+        "caller": "FINEOS SERVICE DESK",
+        "callerNumber": "1-899-898989",
+        "shortDescription": fields.get("summary"),
+        "description": fields.get("description", ""),
+        "assignedTo": "",
+        "vendorTicketNumber": body.get("key"),
+    }
+    return incident
+
+
+def legacy_jira_put_mapping(body):
+    incident = {
+        "callingSystem": "FINEOS-SERVICE-DESK",
+    }
+    fields = body.get("fields", {})
+    priority = fields.get("priority", {})
+    if priority:
+        impact = "3 - Medium"
+        urgency = "3 - Medium"
+        if priority.get("name") in ("Severity 4", "Severity 5"):
+            urgency = "4 - Low"
+        incident["impact"] = impact
+        incident["urgency"] = urgency
+    if fields.get("summary"):
+        incident["shortDescription"] = fields.get("summary")
+    if fields.get("description"):
+        incident["description"] = fields.get("description", "")
+    if fields.get("comment"):
+        incident["workNotes"] = fields.get("comment", "")
+    return incident
+
+
+def legacy_snow_post_mapping(fields):
+    params = Parameters.preload(
+        Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID,
+        Parameters.JIRA_ACTUAL_RESULT_FIELD_ID,
+        Parameters.JIRA_EXPECTED_RESULT_FIELD_ID,
+        Parameters.JIRA_ENVIRONMENT_FIELD_ID,
+        Parameters.JIRA_SERVICE_DESK_ID,
+        Parameters.JIRA_REQUEST_TYPE_ID,
+    )
+    custom_field_id = params[Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID]
+    actual_result_field_id = params[Parameters.JIRA_ACTUAL_RESULT_FIELD_ID]
+    expected_result_field_id = params[Parameters.JIRA_EXPECTED_RESULT_FIELD_ID]
+    environment_field_id = params[Parameters.JIRA_ENVIRONMENT_FIELD_ID]
+
+    description = "{}\n\nReported by: {}".format(
+        fields["description"], fields["reportedby"]
+    )
+    return {
+        "serviceDeskId": int(params[Parameters.JIRA_SERVICE_DESK_ID]),
+        "requestTypeId": int(params[Parameters.JIRA_REQUEST_TYPE_ID]),
+        "requestFieldValues": {
+            custom_field_id: fields["snow_incident_number"],
+            actual_result_field_id: "N/A",
+            expected_result_field_id: "N/A",
+            environment_field_id: {
+                "value": "Production",
+            },
+            "priority": {
+                "name": "Severity {}".format(fields["priority"]),
+            },
+            "summary": fields["summary"],
+            "description": description,
+        }
+    }
+
+
+def legacy_snow_put_mapping(fields):
+    values = {}
+    if "snow_incident_number" in fields:
+        custom_field_id = Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID.get()
+        values[custom_field_id] = fields["snow_incident_number"]
+    if "priority" in fields:
+        values["priority"] = {
+            "name": "Severity {}".format(fields["priority"]),
+        }
+    if "summary" in fields:
+        values["summary"] = fields["summary"]
+    if "description" in fields:
+        values["description"] = fields["description"]
+    if "status" in fields:
+        values["status"] = fields["status"]
+    if "comment" in fields:
+        values["comment"] = fields["comment"]
+    if "reportedby" in fields:
+        values["reportedby"] = fields["reportedby"]
+    return values
+
+
+JIRA_BODIES = [
+    {
+        "key": "FSD-1",
+        "fields": {
+            "priority": {"name": "Severity 2"},
+            "summary": "Payment batch fails",
+            "description": "The nightly payment batch fails with a timeout.",
+        },
+    },
+    {
+        "key": "FSD-2",
+        "fields": {
+            "priority": {"name": "Severity 5"},
+            "comment": "Retried, still failing.",
+        },
+    },
+    {"key": "FSD-3", "fields": {"summary": "No priority"}},
+]
+
+SNOW_BODIES = [
+    {
+        "snow_incident_number": "INC0001",
+        "reportedby": "Jane Doe",
+        "priority": "2",
+        "summary": "Payment batch fails",
+        "description": "The nightly payment batch fails with a timeout.",
+    },
+    {
+        "snow_incident_number": "INC0002",
+        "reportedby": "John Doe",
+        "priority": "4",
+        "summary": "Report is slow",
+        "description": "",
+        "status": "In Progress",
+        "comment": "Vendor is looking into it.",
+    },
+]
+
+CASES = [
+    ("jira post_mapping", legacy_jira_post_mapping, jira_message_processor.post_mapping, JIRA_BODIES),
+    ("jira put_mapping", legacy_jira_put_mapping, jira_message_processor.put_mapping, JIRA_BODIES),
+    ("snow post_mapping", legacy_snow_post_mapping, snow_message_processor.post_mapping, SNOW_BODIES),
+    ("snow put_mapping", legacy_snow_put_mapping, snow_message_processor.put_mapping, SNOW_BODIES),
+]
+
+
+def per_call_us(func, bodies, number):
+    def run():
+        for body in bodies:
+            func(body)
+    return min(timeit.repeat(run, number=number, repeat=5)) / (number * len(bodies)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'mapping':<20} {'legacy us':>10} {'table us':>10} {'speedup':>8}")
+    for name, legacy, table, bodies in CASES:
+        for body in bodies:
+            expected, actual = legacy(body), table(body)
+            if expected != actual:
+                raise SystemExit(f"{name}: outputs differ for {body}\n{expected}\n{actual}")
+        legacy_us = per_call_us(legacy, bodies, args.number)
+        table_us = per_call_us(table, bodies, args.number)
+        print(f"{name:<20} {legacy_us:>10.2f} {table_us:>10.2f} {legacy_us / table_us:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Replay benchmark: warm-invocation latency, outbound calls and peak memory of
+every handler.
+
+Synthetic events for each entry point of `template.yaml` (API Gateway
+POST/PUT of both processors, presign GETs, queue batches and S3
+ObjectCreated batches with small and large attachments) are replayed with
+SSM, S3, Jira and ServiceNow stubbed locally, so it runs without network.
+Latency percentiles include the simulated latencies from `stubs.LATENCY`;
+`--no-latency` sets them to zero to measure the handlers' own overhead.
+Peak memory is traced (`tracemalloc`) in a separate run of each scenario so
+that tracing does not skew the timings.
+
+    python benchmarks/replay.py [--iterations N] [--scenario NAME] [--no-latency] [--json]
+"""
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [os.path.join(ROOT, "src"), BENCH_DIR]
+
+from cold_start import Context, environment  # noqa: E402
+
+os.environ.update(environment())
+
+import events  # noqa: E402
+import stubs  # noqa: E402
+
+KB = 1024
+MB = 1024 * KB
+
+# (name, handler, event builder)
+SCENARIOS = [
+    ("jira-post", "jira_message_processor.handler", events.jira_post_event),
+    ("jira-put", "jira_message_processor.handler", events.jira_put_event),
+    ("jira-worker", "jira_message_processor.worker_handler", events.jira_worker_event),
+    ("snow-post", "snow_message_processor.handler", events.snow_post_event),
+    ("snow-put", "snow_message_processor.handler", events.snow_put_event),
+    ("snow-bulk-post-20", "snow_message_processor.handler",
+     lambda: events.snow_bulk_post_event(20)),
+    ("snow-bulk-put-20", "snow_message_processor.handler",
+     lambda: events.snow_bulk_put_event(20)),
+    ("presign-get", "s3_presigned_url.handler", events.presign_event),
+    ("presign-batch-20", "s3_presigned_url.handler", lambda: events.presign_batch_event(20)),
+    ("presign-multipart-5GB", "s3_presigned_url.handler", events.presign_multipart_event),
+    ("presign-complete-80", "s3_presigned_url.handler", events.presign_complete_event),
+    ("jsd-to-s3-3x100KB", "jsd_to_s3.handler",
+     lambda: events.jsd_to_s3_event((100 * KB,) * 3)),
+    ("jsd-to-s3-1x20MB", "jsd_to_s3.handler",
+     lambda: events.jsd_to_s3_event((20 * MB,))),
+    ("jsd-to-s3-comment-text", "jsd_to_s3.handler",
+     lambda: events.jsd_comment_event("Retried, still failing on file-1.bin and file-12.bin.")),
+    ("jsd-to-s3-comment-adf", "jsd_to_s3.handler",
+     lambda: events.jsd_comment_event(events.adf_comment("file-1.bin", "file-12.bin"))),
+    ("jsd-to-s3-comment-link", "jsd_to_s3.handler",
+     lambda: events.jsd_comment_event(
+         f"See [^file-7.bin] and {stubs.JIRA_HOST}/secure/attachment/1012/file-12.bin")),
+    ("s3-to-jsd-6x100KB", "s3_to_jsd.handler",
+     lambda: events.s3_to_jsd_event((100 * KB,) * 6, issue_keys=("FSD-1", "FSD-2"))),
+    ("s3-to-jsd-1x20MB", "s3_to_jsd.handler",
+     lambda: events.s3_to_jsd_event((20 * MB,))),
+    ("s3-to-snow-6x100KB", "s3_to_snow.handler",
+     lambda: events.s3_to_snow_event((100 * KB,) * 6, incident_numbers=("INC0001", "INC0002"))),
+    ("s3-to-snow-1x20MB", "s3_to_snow.handler",
+     lambda: events.s3_to_snow_event((20 * MB,))),
+]
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a non-empty list.
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def resolve(handler):
+    module_name, function_name = handler.split(".")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def invoke(func, build):
+    """
+    Run one invocation; returns `(seconds, {dependency: calls})`. The
+    handlers' metrics and log output is discarded.
+    """
+    event = build()
+    stubs.reset()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        func(event, Context())
+        elapsed = time.perf_counter() - started
+    return elapsed, dict(stubs.CALLS)
+
+
+def run_scenario(name, handler, build, iterations):
+    func = resolve(handler)
+    # Warm up: imports, clients, SSM cache and tokens
+    invoke(func, build)
+    timings = []
+    calls = {}
+    for _ in range(iterations):
+        elapsed, counts = invoke(func, build)
+        timings.append(elapsed * 1000)
+        for dependency, count in counts.items():
+            calls[dependency] = calls.get(dependency, 0) + count
+
+    tracemalloc.start()
+    try:
+        invoke(func, build)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "scenario": name,
+        "handler": handler,
+        "iterations": iterations,
+        "p50_ms": percentile(timings, 50),
+        "p95_ms": percentile(timings, 95),
+        "p99_ms": percentile(timings, 99),
+        "calls": {dependency: count / iterations for dependency, count in sorted(calls.items())},
+        "peak_kb": peak / KB,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--scenario", action="append",
+                        help="Run only the scenarios starting with this prefix (repeatable)")
+    parser.add_argument("--no-latency", action="store_true")
+    parser.add_argument("--json", action="store_true", help="Print one JSON result per line")
+    args = parser.parse_args()
+
+    if args.no_latency:
+        stubs.LATENCY.clear()
+    stubs.install()
+
+    scenarios = [
+        scenario for scenario in SCENARIOS
+        if not args.scenario or any(scenario[0].startswith(prefix) for prefix in args.scenario)
+    ]
+    if not args.json:
+        print(f"{'scenario':<22} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KB':>10}  calls/invocation")
+    for name, handler, build in scenarios:
+        result = run_scenario(name, handler, build, args.iterations)
+        if args.json:
+            print(json.dumps(result))
+            continue
+        calls = ", ".join(f"{dependency}={count:g}" for dependency, count in result["calls"].items())
+        print(f"{name:<22} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+              f"{result['p99_ms']:>9.1f} {result['peak_kb']:>10.0f}  {calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Offline stand-ins for SSM, S3, Jira and ServiceNow.
+
+`install()` patches `boto3.client` and `requests.adapters.HTTPAdapter.send`
+so the handlers run unchanged without network access. Every outbound call is
+counted per dependency in `CALLS` and can be given a simulated latency.
+"""
+import collections
+import io
+import json
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+STAGE = "bench"
+JIRA_HOST = "https://jira.example.com"
+SNOW_HOST = "https://snow.example.com"
+
+# Simulated round-trip time (seconds) per dependency
+LATENCY = {
+    "ssm": 0.02,
+    "s3": 0.03,
+    "jira": 0.08,
+    "snow": 0.1,
+}
+
+CALLS = collections.Counter()
+BYTES = collections.Counter()
+_calls_lock = threading.Lock()
+
+# S3 object sizes by key, used by `get_object` / `download_file`
+OBJECTS = {}
+# Attachments listed on every issue, `{"id", "filename"}` dicts
+ISSUE_ATTACHMENTS = [
+    {"id": "100", "filename": "screenshot.png"},
+    {"id": "101", "filename": "log.txt"},
+]
+
+
+def parameters():
+    return {
+        f"/{STAGE}/JiraHost": JIRA_HOST,
+        f"/{STAGE}/JiraUserId": "bench@example.com",
+        f"/{STAGE}/JiraAppPassword": "secret",
+        f"/{STAGE}/JiraCustomerRefNoFieldId": "customfield_10001",
+        f"/{STAGE}/JiraActualResultFieldId": "customfield_10002",
+        f"/{STAGE}/JiraExpectedResultFieldId": "customfield_10003",
+        f"/{STAGE}/JiraEnvironmentFieldId": "customfield_10004",
+        f"/{STAGE}/JiraServiceDeskId": "1",
+        f"/{STAGE}/JiraRequestTypeId": "10",
+        f"/{STAGE}/SnowHost": SNOW_HOST,
+        f"/{STAGE}/SnowClientId": "client-id",
+        f"/{STAGE}/SnowAuthUserName": "snow-user",
+        f"/{STAGE}/SnowAuthPassword": "secret",
+        f"/{STAGE}/SnowAuthUrl": f"{SNOW_HOST}/authorization/token",
+        f"/{STAGE}/S3PresignUrlTtl": "3600",
+    }
+
+
+def record_call(dependency, nbytes=0):
+    with _calls_lock:
+        CALLS[dependency] += 1
+        BYTES[dependency] += nbytes
+    time.sleep(LATENCY.get(dependency, 0))
+
+
+def reset():
+    with _calls_lock:
+        CALLS.clear()
+        BYTES.clear()
+    # Replayed events would find their tickets linked already otherwise
+    links = sys.modules.get("links")
+    if links is not None:
+        links._index.reset()
+
+
+def payload(size):
+    """
+    Deterministic attachment content of `size` bytes.
+    """
+    block = bytes(range(256))
+    return (block * (size // 256 + 1))[:size]
+
+
+class ChunkedReader(io.RawIOBase):
+    """
+    Readable stream of `size` bytes which never holds more than one read.
+    """
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.remaining)
+        buffer[:n] = payload(n)
+        self.remaining -= n
+        return n
+
+
+class FakeSSM:
+    class exceptions:
+        class ParameterNotFound(Exception):
+            pass
+
+    def __init__(self):
+        self.values = parameters()
+        self.versions = collections.Counter()
+
+    def _parameter(self, name):
+        return {"Name": name, "Value": self.values[name], "Version": self.versions[name] + 1}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        record_call("ssm")
+        if Name not in self.values:
+            raise self.exceptions.ParameterNotFound(Name)
+        return {"Parameter": self._parameter(Name)}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        record_call("ssm")
+        return {
+            "Parameters": [self._parameter(name) for name in Names if name in self.values],
+            "InvalidParameters": [name for name in Names if name not in self.values],
+        }
+
+    def put_parameter(self, Name, Value, Type=None, Overwrite=False):
+        record_call("ssm")
+        self.values[Name] = Value
+        self.versions[Name] += 1
+        return {"Version": self.versions[Name] + 1}
+
+
+class FakeS3:
+    def get_object(self, Bucket, Key, **kwargs):
+        record_call("s3")
+        size = OBJECTS.get(Key, 1024)
+        return {"Body": io.BufferedReader(ChunkedReader(size)), "ContentLength": size}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        record_call("s3", OBJECTS.get(Key, 1024))
+        with open(Filename, "wb") as out:
+            reader = ChunkedReader(OBJECTS.get(Key, 1024))
+            for chunk in iter(lambda: reader.read(1024 * 1024), b""):
+                out.write(chunk)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        nbytes = 0
+        for chunk in iter(lambda: Fileobj.read(1024 * 1024), b""):
+            nbytes += len(chunk)
+        record_call("s3", nbytes)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        record_call("s3")
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        record_call("s3")
+        return {"Deleted": [{"Key": item["Key"]} for item in Delete["Objects"]]}
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        # Signing is local, no round trip
+        return {"url": f"https://{Bucket}.s3.amazonaws.com/", "fields": {"key": Key}}
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, HttpMethod=None):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?partNumber={Params.get('PartNumber')}"
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        record_call("s3")
+        return {"Bucket": Bucket, "Key": Key, "UploadId": "upload-1"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        record_call("s3")
+        return {"Bucket": Bucket, "Key": Key}
+
+
+def fake_client(service_name, *args, **kwargs):
+    return {"ssm": FakeSSM, "s3": FakeS3}[service_name]()
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    if hasattr(body, "read"):
+        return sum(len(chunk) for chunk in iter(lambda: body.read(1024 * 1024), b""))
+    return sum(len(chunk) for chunk in body)
+
+
+def jira_route(method, path):
+    """
+    Return `(status, json_body or bytes)` for a Jira request.
+    """
+    match = re.match(r"^/rest/servicedeskapi/request/([^/]+)$", path)
+    if match and method == "GET":
+        return 200, {
+            "issueKey": match.group(1),
+            "serviceDeskId": "1",
+            "requestFieldValues": [
+                {"fieldId": "summary", "value": "Summary"},
+                {"fieldId": "description", "value": "Description"},
+                {"fieldId": "priority", "value": {"name": "Severity 3"}},
+            ],
+            "currentStatus": {"status": "Open"},
+        }
+    if path == "/rest/servicedeskapi/request" and method == "POST":
+        return 201, {"issueKey": "FSD-1"}
+    if path.endswith("/attachTemporaryFile"):
+        return 201, {"temporaryAttachments": [{"temporaryAttachmentId": "temp-1"}]}
+    if path.endswith("/attachment") and method == "POST":
+        return 201, {"attachments": {"values": []}}
+    if path.endswith("/comment"):
+        return 201, {"id": "1"}
+    if path.startswith("/rest/api/latest/issue/") and method == "PUT":
+        return 204, None
+    if path.startswith("/rest/api/3/issue/"):
+        return 200, {"fields": {"attachment": ISSUE_ATTACHMENTS}}
+    match = re.match(r"^/secure/attachment/([^/]+)/", path)
+    if match:
+        return 200, OBJECTS.get(f"attachment/{match.group(1)}", 1024)
+    return 404, {"errorMessages": [path]}
+
+
+def snow_route(method, path):
+    if path == "/authorization/token":
+        return 200, {
+            "access_token": "token",
+            "token_type": "Bearer",
+            "expires": int(time.time()) + 3600,
+        }
+    if path == "/itsm-incident/process/incidents" and method == "POST":
+        return 201, {"number": "INC0001"}
+    if path.startswith("/itsm-incident/process/incidents"):
+        return 200, {"result": "ok"}
+    return 404, {"error": path}
+
+
+def fake_send(adapter, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+    from urllib3 import HTTPResponse
+
+    url = urlparse(request.url)
+    if url.netloc == urlparse(JIRA_HOST).netloc:
+        dependency, route = "jira", jira_route
+    else:
+        dependency, route = "snow", snow_route
+    record_call(dependency, _body_size(request.body))
+    status, content = route(request.method, url.path)
+    headers = {}
+    if isinstance(content, int):
+        body = io.BufferedReader(ChunkedReader(content))
+        headers["Content-Type"] = "application/octet-stream"
+    else:
+        body = io.BytesIO(json.dumps(content).encode("utf-8") if content is not None else b"")
+        headers["Content-Type"] = "application/json"
+    raw = HTTPResponse(body=body, headers=headers, status=status, preload_content=False)
+    return adapter.build_response(request, raw)
+
+
+def install():
+    """
+    Route every boto3 client and every `requests` call to the stubs.
+    """
+    import boto3
+    import requests.adapters
+
+    boto3.client = fake_client
+    requests.adapters.HTTPAdapter.send = fake_send
@@ -0,0 +1,110 @@
+"""
+Attachment references of a Jira comment.
+
+A comment body is either an Atlassian Document Format (ADF) document, as a
+dict or its JSON text, or wiki markup. Attachments show up as:
+
+* ADF `media` / `mediaInline` nodes, whose `alt` is the file name, or whose
+  `url` (external media) points at the attachment;
+* links (`link` marks, `inlineCard` / `blockCard` nodes) to an attachment
+  URL, which carry its ID and usually its file name;
+* wiki markup `!file.png|thumbnail!` and `[^file.txt]`.
+
+`parse` returns the attachment IDs and file names found, so that only those
+attachments are looked up and copied. A body mentioning neither media nor
+attachments is recognized without being parsed.
+"""
+import collections
+import json
+import re
+from urllib.parse import unquote
+
+ATTACHMENT_URL = re.compile(
+    r'/(?:secure/attachment|rest/api/[23]/attachment/content)/(\d+)(?:/([^/?#\s"\]|]+))?')
+WIKI_IMAGE = re.compile(r'!([^\s!|][^!|\n]*\.\w+)(?:\|[^!\n]*)?!')
+WIKI_FILE = re.compile(r'\[\^([^\]\n]+)\]')
+
+MEDIA_NODES = ('media', 'mediaInline')
+CARD_NODES = ('inlineCard', 'blockCard')
+# Substrings without which a body cannot reference an attachment
+ADF_MARKERS = ('"media', 'attachment')
+WIKI_MARKERS = ('!', '[^', 'attachment')
+
+
+class References:
+    """
+    `ids` maps attachment IDs to their file name (`None` when unknown);
+    `names` are file names referenced without an ID, in order.
+    """
+    __slots__ = ('ids', 'names')
+
+    def __init__(self):
+        self.ids = collections.OrderedDict()
+        self.names = []
+
+    def __bool__(self):
+        return bool(self.ids or self.names)
+
+    def add_url(self, url):
+        for attachment_id, file_name in ATTACHMENT_URL.findall(url or ''):
+            if file_name or attachment_id not in self.ids:
+                self.ids[attachment_id] = unquote(file_name) if file_name else None
+
+    def add_name(self, file_name):
+        if file_name and file_name not in self.names:
+            self.names.append(file_name)
+
+
+def _walk_adf(document, refs):
+    nodes = [document]
+    while nodes:
+        node = nodes.pop()
+        if not isinstance(node, dict):
+            continue
+        attrs = node.get('attrs') or {}
+        if node.get('type') in MEDIA_NODES:
+            if attrs.get('type') == 'external':
+                refs.add_url(attrs.get('url'))
+            else:
+                refs.add_name(attrs.get('alt'))
+        elif node.get('type') in CARD_NODES:
+            refs.add_url(attrs.get('url'))
+        for mark in node.get('marks') or ():
+            if mark.get('type') == 'link':
+                refs.add_url((mark.get('attrs') or {}).get('href'))
+        # Reversed so that references keep the document order
+        nodes.extend(reversed(node.get('content') or ()))
+
+
+def _parse_wiki(text, refs):
+    refs.add_url(text)
+    for file_name in WIKI_IMAGE.findall(text):
+        refs.add_name(file_name.strip())
+    for file_name in WIKI_FILE.findall(text):
+        refs.add_name(file_name.strip())
+
+
+def parse(body):
+    """
+    Return the `References` of a comment body.
+    """
+    refs = References()
+    if isinstance(body, str):
+        stripped = body.lstrip()
+        if stripped.startswith('{'):
+            if not any(marker in body for marker in ADF_MARKERS):
+                return refs
+            try:
+                body = json.loads(body)
+            except ValueError:
+                pass
+        elif not any(marker in body for marker in WIKI_MARKERS):
+            return refs
+    if isinstance(body, dict):
+        _walk_adf(body, refs)
+    elif isinstance(body, str):
+        _parse_wiki(body, refs)
+    # Names already known with an ID need no lookup
+    known = set(refs.ids.values())
+    refs.names = [file_name for file_name in refs.names if file_name not in known]
+    return refs
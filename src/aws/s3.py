@@ -0,0 +1,127 @@
+"""
+Shared S3 transfer helpers.
+"""
+import threading
+from urllib.parse import unquote_plus
+
+import boto3
+import idempotency
+from boto3.s3.transfer import TransferConfig
+from botocore.client import Config
+from metrics import InstrumentedClient
+from settings import S3_MAX_CONCURRENCY, S3_MULTIPART_CHUNK_SIZE
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class ObjectsLeft(Exception):
+    """
+    Raised by a handler whose S3 event has objects left to process, so that
+    Lambda delivers the event again.
+    """
+
+# Memory used by a streamed upload is bounded by
+# `multipart_chunksize * max_concurrency`, whatever the object size.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+    max_concurrency=S3_MAX_CONCURRENCY,
+)
+
+
+def get_client():
+    """
+    Return the S3 client shared by all modules, created on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = InstrumentedClient(
+                boto3.client('s3', config=Config(signature_version='s3v4')), 's3')
+        return _client
+
+
+# DeleteObjects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+
+def delete_objects(bucket, keys):
+    """
+    Delete `keys` from `bucket` with as few DeleteObjects calls as possible.
+    """
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        get_client().delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in keys[i:i + DELETE_BATCH_SIZE]],
+            'Quiet': True,
+        })
+
+
+def open_object(bucket, key, size):
+    """
+    Return a function opening the body of the object, checking that it is
+    still `size` bytes long. Meant for the lazily opened streams of
+    `clients.jsd.MultipartBody` and `clients.snow.AttachmentsBody`.
+    """
+    def open_body():
+        obj = get_client().get_object(Bucket=bucket, Key=key)
+        if obj['ContentLength'] != size:
+            obj['Body'].close()
+            raise IOError(f'{key}: size changed from {size} to {obj["ContentLength"]} bytes')
+        return obj['Body']
+    return open_body
+
+
+def record_id(record):
+    """
+    Identity of the object version an S3 event record is about, the same on
+    every delivery of the event.
+    """
+    obj = record['s3']['object']
+    version = obj.get('sequencer') or obj.get('eTag', '')
+    return f"{record['s3']['bucket']['name']}/{obj['key']}:{version}"
+
+
+def claim_records(scope, records):
+    """
+    Return the S3 event records not processed by an earlier delivery of the
+    event, claimed in the idempotency store, and the claim key of every
+    claimed `(bucket, key)` to complete or release once processed.
+    """
+    claimed = []
+    claims = {}
+    try:
+        for record in records:
+            claim_key = f'{scope}:{record_id(record)}'
+            if idempotency.claim(claim_key):
+                bucket = record['s3']['bucket']['name']
+                key = unquote_plus(record['s3']['object']['key'])
+                claims[(bucket, key)] = claim_key
+                claimed.append(record)
+    except Exception:
+        # A retry of the event must be able to claim them again
+        for claim_key in claims.values():
+            idempotency.release(claim_key)
+        raise
+    return claimed, claims
+
+
+def settle_claims(claims, bucket, keys, unsent):
+    """
+    Complete the claims of the `keys` of `bucket` which were processed and
+    release those of the `unsent` ones, so that a retry of the event picks
+    them up. The settled claims are removed from `claims`.
+    """
+    for key in keys:
+        claim_key = claims.pop((bucket, key))
+        if key in unsent:
+            idempotency.release(claim_key)
+        else:
+            idempotency.complete(claim_key)
+
+
+def upload_stream(stream, bucket, key):
+    """
+    Upload a non-seekable file-like `stream` to S3 part by part.
+    """
+    get_client().upload_fileobj(stream, bucket, key, Config=TRANSFER_CONFIG)
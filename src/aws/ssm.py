@@ -1,17 +1,151 @@
+"""
+Process-wide SSM parameter cache.
+
+Values are fetched with batched `GetParameters` calls
+and kept in memory for `SsmCacheTtl` seconds, so warm invocations of a
+container do not go back to SSM for every lookup.
+"""
+import os
+import threading
+import time
+
 import boto3
+from metrics import InstrumentedClient
+
+# GetParameters accepts at most 10 names per call
+BATCH_SIZE = 10
+CACHE_TTL = int(os.environ.get('SsmCacheTtl', '300'))
+
+_client = None
+_client_lock = threading.Lock()
+_cache = {}
+_lock = threading.RLock()
+
+
+class ParameterNotFound(Exception):
+    pass
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = InstrumentedClient(boto3.client('ssm'), 'ssm')
+        return _client
+
+
+def _store(parameter, now):
+    """
+    Put a parameter returned by SSM into the cache. An entry that already
+    holds a newer version (e.g. written by `put_ssm_value` while the fetch
+    was in flight) is kept.
+    """
+    name = parameter['Name']
+    version = parameter.get('Version', 0)
+    cached = _cache.get(name)
+    if cached and cached['version'] > version:
+        return
+    _cache[name] = {
+        'value': parameter['Value'],
+        'version': version,
+        'expires': now + CACHE_TTL,
+    }
+
+
+def _is_fresh(name, now):
+    cached = _cache.get(name)
+    return cached is not None and cached['expires'] > now
+
+
+def load_parameters(names, with_decryption=True):
+    """
+    Fetch `names` from SSM in batches of `BATCH_SIZE` and cache them.
+    Expired entries already known to the cache are refreshed in the same
+    round trip. Returns the list of names SSM reported as invalid.
+    """
+    now = time.time()
+    with _lock:
+        stale = [name for name in _cache if not _is_fresh(name, now)]
+    pending = list(dict.fromkeys(list(names) + stale))
+    invalid = []
+    client = get_client()
+    for i in range(0, len(pending), BATCH_SIZE):
+        batch = pending[i:i + BATCH_SIZE]
+        resp = client.get_parameters(Names=batch, WithDecryption=with_decryption)
+        with _lock:
+            for parameter in resp.get('Parameters', []):
+                _store(parameter, now)
+            for name in resp.get('InvalidParameters', []):
+                _cache.pop(name, None)
+        invalid.extend(resp.get('InvalidParameters', []))
+    return invalid
+
+
+def get_parameters(names, with_decryption=True):
+    """
+    Return a `{name: value}` dict for `names`. Only the names missing from
+    the cache (or expired) are requested from SSM.
+    """
+    now = time.time()
+    with _lock:
+        missing = [name for name in names if not _is_fresh(name, now)]
+    if missing:
+        load_parameters(missing, with_decryption=with_decryption)
+    with _lock:
+        return {name: _cache[name]['value'] for name in names if name in _cache}
+
+
+def get_parameter_value(name, with_decryption=True):
+    """
+    Return the cached value of a single parameter.
+    Raises `ParameterNotFound` if SSM does not know `name`.
+    """
+    values = get_parameters([name], with_decryption=with_decryption)
+    if name not in values:
+        raise ParameterNotFound(name)
+    return values[name]
+
+
+def invalidate(name=None):
+    """
+    Drop `name` (or the whole cache) so that the next lookup goes to SSM.
+    """
+    with _lock:
+        if name is None:
+            _cache.clear()
+        else:
+            _cache.pop(name, None)
+
 
 def get_ssm_value(key, with_decryption=True):
-    ssm = boto3.client('ssm')
     value = None
     error = ''
     try:
-        param = ssm.get_parameter(Name=key, WithDecryption=with_decryption)
-        value = param['Parameter']['Value']
+        value = get_parameter_value(key, with_decryption=with_decryption)
         if not value:
             error = f'SSM key `{key}` is not defined \n'
     except Exception as ex:
         error = f'Cannot get ssm value for key: {key}'
     return error, value
+
+
+def get_ssm_values(keys, with_decryption=True):
+    """
+    Batched variant of `get_ssm_value`, returns `(error, [values])` in the
+    order of `keys`.
+    """
+    error = ''
+    try:
+        values = get_parameters(keys, with_decryption=with_decryption)
+    except Exception as ex:
+        return f'Cannot get ssm values for keys: {", ".join(keys)}', [None] * len(keys)
+    for key in keys:
+        if not values.get(key):
+            error += f'SSM key `{key}` is not defined \n'
+    return error, [values.get(key) for key in keys]
+
+
 def put_ssm_value(key, value, type='SecureString'):
-    ssm = boto3.client('ssm')
-    ssm.put_parameter(Name=key,Value=value,Type=type,Overwrite=True)
\ No newline at end of file
+    resp = get_client().put_parameter(Name=key, Value=value, Type=type, Overwrite=True)
+    with _lock:
+        _store({'Name': key, 'Value': value, 'Version': resp.get('Version', 0)}, time.time())
@@ -0,0 +1,31 @@
+"""
+Pluggable storage backends selected by a setting.
+
+The queue (`queues`), the idempotency store (`idempotency`) and the link
+index (`links`) each offer an AWS backend and `sqlite` / `memory` ones for
+local runs and tests. A `Backend` holds the one selected by the module's
+setting, created on first use and shared by all the threads and warm
+invocations of a container.
+"""
+import threading
+
+
+class Backend:
+    def __init__(self, backends, name):
+        self.backends = backends
+        self.name = name
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._instance is None:
+                self._instance = self.backends[self.name]()
+            return self._instance
+
+    def reset(self):
+        """
+        Drop the instance; the next `get` creates a new one.
+        """
+        with self._lock:
+            self._instance = None
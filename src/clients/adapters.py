@@ -0,0 +1,41 @@
+"""
+Transport adapters shared by the HTTP clients.
+"""
+from requests.adapters import HTTPAdapter
+
+from clients import resilience
+from metrics import operation_name, timed
+from settings import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from workers import cap_timeout
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """
+    Pooled adapter recording every request in `metrics` under `dependency`.
+    Requests go through the dependency's circuit breaker and bulkhead
+    (`clients.resilience`), with the default timeouts when none is given,
+    capped to the time left to the invocation (`workers.start_deadline`).
+    """
+
+    def __init__(self, dependency, *args, **kwargs):
+        self.dependency = dependency
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        timeout = cap_timeout(kwargs['timeout'])
+        capped = timeout != kwargs['timeout']
+        kwargs['timeout'] = timeout
+        operation = operation_name(request.method, request.url)
+        return resilience.call(
+            self.dependency, operation,
+            lambda: self._send(operation, request, *args, **kwargs), capped=capped)
+
+    def _send(self, operation, request, *args, **kwargs):
+        with timed(self.dependency, operation) as call:
+            call.bytes_sent = int(request.headers.get('Content-Length') or 0)
+            response = super().send(request, *args, **kwargs)
+            call.status = response.status_code
+            call.bytes_received = int(response.headers.get('Content-Length') or 0)
+            return response
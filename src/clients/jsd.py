@@ -1,35 +1,72 @@
 """
 The Jira Service Desk Cloud REST API client.
 """
+import collections
+import copy
 import os
-import boto3
+import threading
+import time
+import uuid
+
 import requests
 from requests.auth import HTTPBasicAuth
-from settings import Parameters
+from clients.adapters import InstrumentedAdapter
+from clients.resilience import SourceError, reading_source
+from metrics import increment
+from settings import (HTTP_CONNECT_TIMEOUT, HTTP_POOL_SIZE, HTTP_READ_TIMEOUT, JIRA_CACHE_SIZE,
+                      JIRA_CACHE_TTL, Parameters)
 
 class ClientError(Exception):
-    pass
-
-
-def get_param_value(name):
-    client = boto3.client("ssm")
-    parameter = client.get_parameter(Name=name, WithDecryption=True)
-    return parameter["Parameter"]["Value"]
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
 
 
-JIRA_API_URL = get_param_value(Parameters.JIRA_HOST.value)
-JIRA_SERVICE_DESK_ID = get_param_value(Parameters.JIRA_SERVICE_DESK_ID.value)
-
-session = requests.Session()
-session.auth = HTTPBasicAuth(
-    get_param_value(Parameters.JIRA_USER_ID.value),
-    get_param_value(Parameters.JIRA_APP_PASSWORD.value)
-)
-session.headers = {
+JSON_HEADERS = {
     "Accept": "application/json",
     "Content-Type": "application/json",
 }
 
+# The session is created on first use and shared by all threads, so it is
+# never mutated afterwards; request specific headers are passed with every
+# request instead.
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_api_url():
+    return Parameters.JIRA_HOST.get()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            params = Parameters.preload(
+                Parameters.JIRA_HOST,
+                Parameters.JIRA_USER_ID,
+                Parameters.JIRA_APP_PASSWORD,
+            )
+            session = requests.Session()
+            session.auth = HTTPBasicAuth(
+                params[Parameters.JIRA_USER_ID],
+                params[Parameters.JIRA_APP_PASSWORD]
+            )
+            adapter = InstrumentedAdapter(
+                "jira", pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def request(method, url, headers=None, **kwargs):
+    """
+    Send a request through the pooled session with explicit timeouts.
+    """
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_session().request(method, url, headers=headers or JSON_HEADERS, **kwargs)
+
 
 def raise_not_ok_exception(response):
     """
@@ -40,19 +77,19 @@ def raise_not_ok_exception(response):
             # Raise an exception this way in order to provide more
             # details (located in `response.text`) than
             # `raise_for_status` provides.
-            raise ClientError(response.text)
+            raise ClientError(response.text, response)
         else:
             response.raise_for_status()
 
 
 def sda_get_request(uri):
-    response = session.get(f"{JIRA_API_URL}/rest/servicedeskapi{uri}")
+    response = request("GET", f"{get_api_url()}/rest/servicedeskapi{uri}")
     raise_not_ok_exception(response)
     return response.json()
 
 
 def sda_post_request(uri, data):
-    response = session.post(f"{JIRA_API_URL}/rest/servicedeskapi{uri}", json=data)
+    response = request("POST", f"{get_api_url()}/rest/servicedeskapi{uri}", json=data)
     raise_not_ok_exception(response)
     if response.text:
         return response.json()
@@ -64,68 +101,273 @@ def get_service_desks():
 
 def get_request_types():
     return sda_get_request(
-        '/rest/servicedesk/{}/requesttype'.format(JIRA_SERVICE_DESK_ID))
+        '/rest/servicedesk/{}/requesttype'.format(Parameters.JIRA_SERVICE_DESK_ID.get()))
 
 
 def create_request(body):
     return sda_post_request('/request', body)
 
 
+class ResponseCache:
+    """
+    Read-through cache of lookups by issue, with least recently used
+    eviction beyond `max_entries` and entries expiring `ttl` seconds after
+    they were fetched. Kept for the lifetime of the container; hits and
+    misses are counted since then and in the invocation's metrics.
+    """
+
+    def __init__(self, max_entries=JIRA_CACHE_SIZE, ttl=JIRA_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation, so that a value fetched while its
+        # issue was written is not stored
+        self.generation = 0
+        # issue id or key -> (expires, aliases, value)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, issue, fetch):
+        """
+        Return a copy of the cached value for `issue`, calling `fetch()` on
+        a miss.
+        """
+        if self.ttl <= 0:
+            return fetch()
+        with self._lock:
+            entry = self._entries.get(issue)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(issue)
+                self.hits += 1
+                increment("jira", "cache_hits")
+                return copy.deepcopy(entry[2])
+            self.misses += 1
+            increment("jira", "cache_misses")
+            generation = self.generation
+        value = fetch()
+        aliases = {issue, str(value.get("issueId")), str(value.get("issueKey"))}
+        with self._lock:
+            if generation != self.generation:
+                return value
+            self._entries[issue] = (time.monotonic() + self.ttl, aliases, copy.deepcopy(value))
+            self._entries.move_to_end(issue)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, issue):
+        """
+        Drop the entries of `issue`, whether cached by id or by key.
+        """
+        issue = str(issue)
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, (_, aliases, _) in self._entries.items() if issue in aliases]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+request_cache = ResponseCache()
+
+
+def cache_stats():
+    """
+    Hits and misses of the request cache since the container started.
+    """
+    return request_cache.stats()
+
+
 def update_issue(issue_id, data):
-    url = f'{JIRA_API_URL}/rest/api/latest/issue/{issue_id}'
-    response = session.put(url, json=data)
+    url = f'{get_api_url()}/rest/api/latest/issue/{issue_id}'
+    try:
+        response = request("PUT", url, json=data)
+    finally:
+        request_cache.invalidate(issue_id)
     raise_not_ok_exception(response)
     if response.text:
         return response.json()
 
 
+def get_issue(issue_id_or_key, fields=None):
+    url = f'{get_api_url()}/rest/api/3/issue/{issue_id_or_key}'
+    params = {'fields': fields} if fields else None
+    response = request("GET", url, params=params)
+    raise_not_ok_exception(response)
+    return response.json()
+
+
 def get_request(issueIdOrKey):
-    return sda_get_request(f'/request/{issueIdOrKey}')
+    """
+    Return the customer request, from `request_cache` when it was fetched
+    less than `JiraCacheTtl` seconds ago and not written since.
+    """
+    return request_cache.get(
+        str(issueIdOrKey), lambda: sda_get_request(f'/request/{issueIdOrKey}'))
 
-def attach_temporary_file(service_desk_id, filename):
+
+def open_attachment(attachment_id, file_name):
     """
-    Create temporary attachment, which can later be converted into permanent attachment
+    Return a streamed response for the attachment content; the caller reads
+    `response.raw` and must close the response.
+    """
+    url = f'{get_api_url()}/secure/attachment/{attachment_id}/{file_name}'
+    response = request("GET", url, headers={"Accept": "*/*"}, stream=True)
+    try:
+        raise_not_ok_exception(response)
+    except Exception:
+        response.close()
+        raise
+    return response
+
+
+# Bytes read from an attachment stream per step when encoding a multipart body
+MULTIPART_CHUNK_SIZE = 1024 * 1024
+
+
+def quote_filename(file_name):
+    """
+    Quote `file_name` for a `Content-Disposition` header the way browsers
+    (and urllib3) do.
+    """
+    return file_name.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+class MultipartBody:
+    """
+    Streaming `multipart/form-data` body.
+
+    `files` is a list of `(file_name, fileobj, size)` tuples sent as `field`
+    parts. Each file is read `chunk_size` bytes at a time while the request
+    is sent, so neither memory nor disk use depend on the file sizes, and the
+    exact length is known up front so `requests` sends a `Content-Length`.
+    `fileobj` may also be a function returning the stream: it is called when
+    its part is reached and the stream is closed afterwards, so only one
+    stream is open at a time.
+    """
+
+    def __init__(self, files, field="file", boundary=None, chunk_size=MULTIPART_CHUNK_SIZE):
+        self.files = files
+        self.field = field
+        self.boundary = boundary or uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.tail = f"--{self.boundary}--\r\n".encode("utf-8")
+
+    def part_header(self, file_name):
+        return (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{self.field}"; '
+            f'filename="{quote_filename(file_name)}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+
+    def __len__(self):
+        length = len(self.tail)
+        for file_name, _, size in self.files:
+            length += len(self.part_header(file_name)) + size + 2
+        return length
+
+    def __iter__(self):
+        for file_name, fileobj, size in self.files:
+            yield self.part_header(file_name)
+            with reading_source(file_name):
+                stream = fileobj() if callable(fileobj) else fileobj
+            try:
+                remaining = size
+                while remaining > 0:
+                    with reading_source(file_name):
+                        chunk = stream.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        # The announced Content-Length can no longer be met
+                        raise SourceError(f"{file_name}: stream ended {remaining} bytes early")
+                    remaining -= len(chunk)
+                    yield chunk
+            finally:
+                if callable(fileobj):
+                    stream.close()
+            yield b"\r\n"
+        yield self.tail
+
+
+def attach_temporary_files(service_desk_id, files):
+    """
+    Create temporary attachments, which can later be converted into permanent attachments.
+    Files are streamed, see `MultipartBody`.
     :param service_desk_id: str
-    :param filename: str
-    :return: Temporary Attachment ID
+    :param files: list of `(file_name, fileobj, size)`
+    :return: Temporary Attachment IDs, in the order of `files`
     """
+    body = MultipartBody(files)
     temporary_attachment_headers = {
             "Accept": "application/json",
+            "Content-Type": body.content_type,
             "X-Atlassian-Token": "nocheck",
             "X-ExperimentalApi": "opt-in",
-            "Origin": JIRA_API_URL
+            "Origin": get_api_url()
     }
-    url = f'{JIRA_API_URL}/rest/servicedeskapi/servicedesk/{service_desk_id}/attachTemporaryFile'
-    
+    url = f'{get_api_url()}/rest/servicedeskapi/servicedesk/{service_desk_id}/attachTemporaryFile'
+    response = request("POST", url, headers=temporary_attachment_headers, data=body)
+    raise_not_ok_exception(response)
+    return [
+        attachment.get('temporaryAttachmentId')
+        for attachment in response.json()['temporaryAttachments']
+    ]
+
+
+def attach_temporary_stream(service_desk_id, file_name, fileobj, size):
+    """
+    Create a temporary attachment from a readable stream of `size` bytes
+    :return: Temporary Attachment ID
+    """
+    return attach_temporary_files(service_desk_id, [(file_name, fileobj, size)])[0]
+
+
+def attach_temporary_file(service_desk_id, filename):
+    """
+    Create temporary attachment, which can later be converted into permanent attachment
+    :param service_desk_id: str
+    :param filename: str
+    :return: Temporary Attachment ID
+    """
     with open(filename, 'rb') as file:
-        session.headers = temporary_attachment_headers
-        response = session.post(url=url,
-                            files={'file': file})
-        raise_not_ok_exception(response)
-        temp_attachment_id = response.json()['temporaryAttachments'][0].get('temporaryAttachmentId')
+        return attach_temporary_stream(
+            service_desk_id, os.path.basename(filename), file, os.fstat(file.fileno()).st_size)
+
 
-        return temp_attachment_id
 def add_attachment(issue_id_or_key, temp_attachment_id, public=True, comment=None):
     """
-    Adds temporary attachment to customer request using attach_temporary_file function
+    Adds temporary attachments to customer request using attach_temporary_file(s) function
     :param issue_id_or_key: str
-    :param temp_attachment_id: str, ID from result attach_temporary_file function
+    :param temp_attachment_id: str or list of str, IDs from result attach_temporary_file(s) function
     :param public: bool (default is True)
     :param comment: str (default is None)
     :return:
     """
-    data = {'temporaryAttachmentIds': [temp_attachment_id],
+    if isinstance(temp_attachment_id, str):
+        temp_attachment_id = [temp_attachment_id]
+    data = {'temporaryAttachmentIds': list(temp_attachment_id),
             'public': public,
             'additionalComment': {'body': comment}}
-    url = f'{JIRA_API_URL}/rest/servicedeskapi/request/{issue_id_or_key}/attachment'
+    url = f'{get_api_url()}/rest/servicedeskapi/request/{issue_id_or_key}/attachment'
     add_attachment_headers = {
             "Accept": "application/json",
-            "Content-Type": "application/json",     
-            "Origin": JIRA_API_URL
+            "Content-Type": "application/json",
+            "Origin": get_api_url()
     }
-    session.headers = add_attachment_headers
-    response = session.post(url=url,
-                            json=data)
+    try:
+        response = request("POST", url,
+                           headers=add_attachment_headers,
+                           json=data)
+    finally:
+        request_cache.invalidate(issue_id_or_key)
     raise_not_ok_exception(response)
     return response.json()
 
@@ -135,4 +377,7 @@ def create_comment(issueIdOrKey, comment, public=True):
         "body": comment,
         "public": public,
     }
-    return sda_post_request(f'/request/{issueIdOrKey}/comment', body)
+    try:
+        return sda_post_request(f'/request/{issueIdOrKey}/comment', body)
+    finally:
+        request_cache.invalidate(issueIdOrKey)
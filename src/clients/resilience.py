@@ -0,0 +1,214 @@
+"""
+Circuit breakers and bulkheads of the HTTP backends.
+
+Every backend (`jira`, `snow`) has one `CircuitBreaker` and one `Bulkhead`,
+kept in module globals so that their state is shared by all the threads and
+warm invocations of a container. Calls go through `call`:
+
+* the bulkhead caps the calls in flight to the backend; a call waiting more
+  than `BulkheadWait` seconds for a slot fails with `BulkheadFull`;
+* after `CircuitFailureThreshold` consecutive failures (connection errors,
+  timeouts, 429 and 5xx responses) the breaker opens and calls fail at once
+  with `CircuitOpen`; after `CircuitResetTimeout` seconds it lets
+  `CircuitHalfOpenCalls` probe calls through, and closes again when they
+  succeed.
+
+Both exceptions are `requests` connection errors, so callers handling a
+failed request need nothing more. A request body failing to read from its
+source raises `SourceError` instead, which is not held against the backend.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+import requests
+from metrics import Call, record
+from settings import (BULKHEAD_MAX_CALLS, BULKHEAD_WAIT, CIRCUIT_FAILURE_THRESHOLD,
+                      CIRCUIT_HALF_OPEN_CALLS, CIRCUIT_RESET_TIMEOUT, get_log_level)
+
+logger = logging.getLogger()
+logger.setLevel(get_log_level())
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_breakers = {}
+_bulkheads = {}
+_registry_lock = threading.Lock()
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    pass
+
+
+class BulkheadFull(requests.exceptions.ConnectionError):
+    pass
+
+
+class SourceError(Exception):
+    """
+    A streamed request body could not be read from its source (an S3 object
+    which changed or ended early). Not an `OSError`, which `requests` would
+    report as a `ConnectionError`.
+    """
+
+
+@contextlib.contextmanager
+def reading_source(name):
+    """
+    Turn the errors of opening or reading the source `name` of a request
+    body into `SourceError`.
+    """
+    try:
+        yield
+    except SourceError:
+        raise
+    except Exception as ex:
+        raise SourceError(f'{name}: {ex}') from ex
+
+
+def is_failure(response):
+    """
+    Whether a response means the backend is unhealthy; other 4xx are the
+    caller's fault and do not count.
+    """
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def is_rejected(ex):
+    """
+    Whether a failed call was refused outright, so the backend cannot have
+    applied it: its body could not be read, or the backend answered with a
+    4xx other than 429. After a timeout or a 5xx the call may have gone
+    through.
+    """
+    if isinstance(ex, SourceError):
+        return True
+    response = getattr(ex, 'response', None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT, half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning('Circuit %s: %s -> %s', self.name, self.state, state)
+            self.state = state
+
+    def before_call(self):
+        """
+        Raise `CircuitOpen` unless the call may go through.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpen(f'Circuit {self.name} is open')
+                self._set_state(HALF_OPEN)
+                self.probes = 0
+            if self.state == HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    raise CircuitOpen(f'Circuit {self.name} is half open, probe in flight')
+                self.probes += 1
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state(CLOSED)
+
+    def on_aborted(self):
+        """
+        The call failed before the backend could answer; give back its probe.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probes = max(0, self.probes - 1)
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+class Bulkhead:
+    def __init__(self, name, max_calls=BULKHEAD_MAX_CALLS, wait=BULKHEAD_WAIT):
+        self.name = name
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(max_calls)
+
+    def __enter__(self):
+        acquired = (self._slots.acquire(timeout=self.wait) if self.wait > 0
+                    else self._slots.acquire(blocking=False))
+        if not acquired:
+            raise BulkheadFull(f'Too many calls in flight to {self.name}')
+        return self
+
+    def __exit__(self, *exc_info):
+        self._slots.release()
+
+
+def get_breaker(name):
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def get_bulkhead(name):
+    with _registry_lock:
+        if name not in _bulkheads:
+            _bulkheads[name] = Bulkhead(name)
+        return _bulkheads[name]
+
+
+def call(name, operation, func, capped=False):
+    """
+    Return `func()`, a call to backend `name` returning a response, through
+    the backend's bulkhead and breaker. Rejected calls are recorded in
+    `metrics` with the status `rejected`. With `capped`, the call's timeout
+    was shortened to the invocation deadline, so timing out is not held
+    against the backend.
+    """
+    breaker = get_breaker(name)
+    try:
+        with get_bulkhead(name):
+            breaker.before_call()
+            try:
+                response = func()
+            except SourceError:
+                breaker.on_aborted()
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                if capped and isinstance(ex, requests.exceptions.Timeout):
+                    breaker.on_aborted()
+                else:
+                    breaker.on_failure()
+                raise
+            except Exception:
+                # Not the backend's fault (e.g. a body that cannot be read)
+                breaker.on_aborted()
+                raise
+    except (CircuitOpen, BulkheadFull):
+        rejected = Call(name, operation)
+        rejected.status = 'rejected'
+        record(rejected)
+        raise
+    if is_failure(response):
+        breaker.on_failure()
+    else:
+        breaker.on_success()
+    return response
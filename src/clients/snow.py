@@ -1,52 +1,65 @@
 """
 The ServiceNow REST API client.
 """
+import base64
 import json
 import logging
 import os
+import threading
 import time
 
-import boto3
 import requests
-from settings import Parameters, get_log_level
+from aws import ssm
+from clients import resilience
+from clients.adapters import InstrumentedAdapter
+from clients.resilience import SourceError, reading_source
+from metrics import operation_name, timed
+from settings import (HTTP_CONNECT_TIMEOUT, HTTP_POOL_SIZE, HTTP_READ_TIMEOUT, Parameters,
+                      get_log_level)
+from workers import cap_timeout
 
 
 class ClientError(Exception):
-    pass
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
 
 
-ssm_client = boto3.client("ssm")
 logger = logging.getLogger()
 logger.setLevel(get_log_level())
 
 
-def get_param_value(name):
-    parameter = ssm_client.get_parameter(Name=name, WithDecryption=True)
-    return parameter["Parameter"]["Value"]
-
+# A parameter for storing token information (access token, expires and
+# type):
+SNOW_API_TOKEN_SSM_PARAM_NAME = Parameters.SNOW_API_TOKEN_SSM_2.value
 
-def put_param_value(name, value, param_type='SecureString'):
-    ssm_client.put_parameter(
-        Name=name, Value=value, Type=param_type, Overwrite=True)
+# If there is 30 seconds (and less) left to the token expiration time we
+# consider that the token is almost expired and requesting another one.
+TOKEN_EXPIRY_MARGIN = 30
 
+# The token and the session are kept for the lifetime of the container
+_token = None
+_session = None
+_token_lock = threading.Lock()
+_session_lock = threading.Lock()
 
-# SNOW REST API URL
-SNOW_API_URL = get_param_value(Parameters.SNOW_HOST.value)
 
-# A parameter for storing token information (access token, expires and
-# type):
-SNOW_API_TOKEN_SSM_PARAM_NAME = Parameters.SNOW_API_TOKEN_SSM_2.value
+def get_api_url():
+    """
+    SNOW REST API URL
+    """
+    return Parameters.SNOW_HOST.get()
 
 
 def get_client_id():
-    return get_param_value(Parameters.SNOW_CLIENT_ID.value)
+    return Parameters.SNOW_CLIENT_ID.get()
 
 
 def get_token():
     param_name = SNOW_API_TOKEN_SSM_PARAM_NAME
     try:
-        token = get_param_value(param_name)
-    except ssm_client.exceptions.ParameterNotFound:
+        token = ssm.get_parameter_value(param_name)
+    except ssm.ParameterNotFound:
         logger.info("Parameter not found: {}".format(param_name))
         return None
     else:
@@ -58,45 +71,170 @@ def get_token():
 
 
 def store_token(token):
-    put_param_value(SNOW_API_TOKEN_SSM_PARAM_NAME, json.dumps(token))
+    ssm.put_ssm_value(SNOW_API_TOKEN_SSM_PARAM_NAME, json.dumps(token))
 
 
 def request_token():
-    auth_url = get_param_value(Parameters.SNOW_AUTH_URL.value)
+    params = Parameters.preload(
+        Parameters.SNOW_AUTH_URL,
+        Parameters.SNOW_AUTH_USER_NAME,
+        Parameters.SNOW_AUTH_PASSWORD,
+        Parameters.SNOW_CLIENT_ID,
+    )
+    auth_url = params[Parameters.SNOW_AUTH_URL]
     auth = (
-        get_param_value(Parameters.SNOW_AUTH_USER_NAME.value),
-        get_param_value(Parameters.SNOW_AUTH_PASSWORD.value),
+        params[Parameters.SNOW_AUTH_USER_NAME],
+        params[Parameters.SNOW_AUTH_PASSWORD],
     )
     headers = {
         "X-IBM-Client-Id": get_client_id(),
     }
-    resp = requests.get(auth_url, auth=auth, headers=headers)
+    operation = operation_name("GET", auth_url)
+    default_timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    timeout = cap_timeout(default_timeout)
+
+    def send():
+        with timed("snow", operation) as call:
+            resp = requests.get(auth_url, auth=auth, headers=headers, timeout=timeout)
+            call.status = resp.status_code
+            return resp
+
+    resp = resilience.call("snow", operation, send, capped=timeout != default_timeout)
     if resp.ok:
         return resp.json()
     else:
         resp.raise_for_status()
 
 
-def mk_session():
-    token = get_token()
-    logger.debug("Token: %s", token)
-    if not token:
-        token = request_token()
-        store_token(token)
-    elif (int(token["expires"]) - round(time.time())) < 30:
-        # If there is 30 seconds (and less) left to the token
-        # expiration time we consider that the token is almost expired
-        # and requesting another one.
-        token = request_token()
-        store_token(token)
-    session = requests.Session()
-    session.headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "X-IBM-Client-Id": get_client_id(),
-        "Authorization": f"{token['token_type']} {token['access_token']}",
-    }
-    return session
+def is_token_valid(token):
+    return bool(token) and (
+        int(token["expires"]) - round(time.time())) >= TOKEN_EXPIRY_MARGIN
+
+
+def get_valid_token():
+    """
+    Return a token which is not about to expire. The in-memory copy is used
+    while it is valid; SSM is only read on a miss or near expiry (another
+    container may have refreshed it already), and a new token is requested
+    only if SSM does not hold a valid one either.
+    """
+    global _token
+    with _token_lock:
+        if is_token_valid(_token):
+            return _token
+        ssm.invalidate(SNOW_API_TOKEN_SSM_PARAM_NAME)
+        token = get_token()
+        if not is_token_valid(token):
+            logger.debug("Requesting a new SNOW token")
+            token = request_token()
+            store_token(token)
+        _token = token
+        return _token
+
+
+def get_session():
+    """
+    Return the container-wide pooled session with an up to date
+    `Authorization` header.
+    """
+    global _session
+    token = get_valid_token()
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = InstrumentedAdapter(
+                "snow", pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+                "X-IBM-Client-Id": get_client_id(),
+            })
+            _session = session
+    authorization = f"{token['token_type']} {token['access_token']}"
+    if _session.headers.get("Authorization") != authorization:
+        _session.headers["Authorization"] = authorization
+    return _session
+
+
+# Raw bytes read per step when encoding attachments; a multiple of 3 so that
+# every chunk base64-encodes without padding.
+ATTACHMENT_CHUNK_SIZE = 3 * 256 * 1024
+
+
+def read_exact(fileobj, size):
+    """
+    Read up to `size` bytes, retrying short reads until EOF.
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = fileobj.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+class AttachmentsBody:
+    """
+    Streaming JSON body for the incident attachments PUT.
+
+    `attachments` is a list of `(file_name, fileobj, size)` tuples. Files are
+    read and base64 encoded one chunk at a time, so memory use does not depend
+    on the file size. The exact encoded length is known up front, which lets
+    `requests` send the body with a `Content-Length` header. As with
+    `clients.jsd.MultipartBody`, `fileobj` may be a function returning the
+    stream, called when its attachment is reached and closed afterwards.
+    """
+
+    def __init__(self, attachments, calling_system="FINEOS-SERVICE-DESK",
+                 chunk_size=ATTACHMENT_CHUNK_SIZE):
+        self.attachments = attachments
+        self.chunk_size = max(3, chunk_size - chunk_size % 3)
+        self.head = '{{"callingSystem": {}, "attachments": ['.format(
+            json.dumps(calling_system)).encode("utf-8")
+        self.tail = b"]}"
+
+    @staticmethod
+    def item_prefix(index, file_name):
+        separator = ", " if index else ""
+        return '{}{{"contentType": "", "fileName": {}, "attachment": "'.format(
+            separator, json.dumps(file_name)).encode("utf-8")
+
+    item_suffix = b'"}'
+
+    def __len__(self):
+        length = len(self.head) + len(self.tail)
+        for index, (file_name, _, size) in enumerate(self.attachments):
+            length += len(self.item_prefix(index, file_name))
+            length += 4 * ((size + 2) // 3)
+            length += len(self.item_suffix)
+        return length
+
+    def __iter__(self):
+        yield self.head
+        for index, (file_name, fileobj, size) in enumerate(self.attachments):
+            yield self.item_prefix(index, file_name)
+            with reading_source(file_name):
+                stream = fileobj() if callable(fileobj) else fileobj
+            try:
+                remaining = size
+                while remaining > 0:
+                    with reading_source(file_name):
+                        chunk = read_exact(stream, min(self.chunk_size, remaining))
+                    if not chunk:
+                        # The announced Content-Length can no longer be met
+                        raise SourceError(f"{file_name}: stream ended {remaining} bytes early")
+                    remaining -= len(chunk)
+                    yield base64.b64encode(chunk)
+            finally:
+                if callable(fileobj):
+                    stream.close()
+            yield self.item_suffix
+        yield self.tail
 
 
 def raise_not_ok_exception(response):
@@ -108,29 +246,29 @@ def raise_not_ok_exception(response):
             # Raise an exception this way in order to provide more
             # details (located in `response.text`) than
             # `raise_for_status` provides.
-            raise ClientError(response.text)
+            raise ClientError(response.text, response)
         else:
             response.raise_for_status()
 
 
 def snow_get_request(uri):
-    session = mk_session()
-    response = session.get(f"{SNOW_API_URL}{uri}")
+    session = get_session()
+    response = session.get(f"{get_api_url()}{uri}")
     raise_not_ok_exception(response)
     return response.json()
 
 
 def snow_post_request(uri, data):
-    session = mk_session()
-    response = session.post(f"{SNOW_API_URL}{uri}", json=data)
+    session = get_session()
+    response = session.post(f"{get_api_url()}{uri}", json=data)
     raise_not_ok_exception(response)
     if response.text:
         return response.json()
 
 
 def snow_put_request(uri, data):
-    session = mk_session()
-    response = session.put(f"{SNOW_API_URL}{uri}", json=data)
+    session = get_session()
+    response = session.put(f"{get_api_url()}{uri}", json=data)
     raise_not_ok_exception(response)
     if response.text:
         return response.json()
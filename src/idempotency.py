@@ -0,0 +1,202 @@
+"""
+Idempotency layer dropping duplicate webhook deliveries.
+
+A request is identified by its ticket (issue key or incident number) and a
+hash of its payload. The first delivery claims the key and stores its
+response; identical deliveries within `IdempotencyWindow` seconds get the
+stored response back without reaching Jira or ServiceNow.
+
+`get_store()` returns the backend selected by `IdempotencyBackend`
+(`dynamodb`, `sqlite` or `memory`, see `backends`).
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import boto3
+from backends import Backend
+from settings import (IDEMPOTENCY_BACKEND, IDEMPOTENCY_PATH, IDEMPOTENCY_TABLE,
+                      IDEMPOTENCY_WINDOW)
+
+logger = logging.getLogger()
+
+
+class MemoryStore:
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def claim(self, key, expires):
+        """
+        Claim `key` until `expires`. Returns `None` when claimed, otherwise
+        the unexpired record already holding it.
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item and item["expires"] > time.time():
+                return item
+            self.items[key] = {"response": None, "expires": expires}
+
+    def complete(self, key, response, expires):
+        with self.lock:
+            self.items[key] = {"response": response, "expires": expires}
+
+    def release(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class SqliteStore:
+    def __init__(self, path=IDEMPOTENCY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                "id TEXT PRIMARY KEY, response TEXT, expires REAL NOT NULL)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def claim(self, key, expires):
+        with self.lock, self.connect() as conn:
+            # Lock the database between the read and the write so that
+            # concurrent processes cannot both claim the key
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT response, expires FROM idempotency WHERE id = ?", (key,)).fetchone()
+            if row and row[1] > time.time():
+                return {"response": json.loads(row[0]) if row[0] else None, "expires": row[1]}
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency (id, response, expires) VALUES (?, NULL, ?)",
+                (key, expires))
+
+    def complete(self, key, response, expires):
+        with self.lock, self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency (id, response, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(response), expires))
+
+    def release(self, key):
+        with self.lock, self.connect() as conn:
+            conn.execute("DELETE FROM idempotency WHERE id = ?", (key,))
+
+
+class DynamoDbStore:
+    """
+    Items are `{id, response, expires}`; `expires` is also the table's TTL
+    attribute so old keys are removed by DynamoDB.
+    """
+
+    def __init__(self, table_name=IDEMPOTENCY_TABLE):
+        self.table_name = table_name
+        self.client = boto3.client('dynamodb')
+
+    def claim(self, key, expires):
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={"id": {"S": key}, "expires": {"N": str(int(expires))}},
+                ConditionExpression="attribute_not_exists(id) OR #expires < :now",
+                ExpressionAttributeNames={"#expires": "expires"},
+                ExpressionAttributeValues={":now": {"N": str(int(time.time()))}},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            item = self.client.get_item(
+                TableName=self.table_name, Key={"id": {"S": key}}, ConsistentRead=True
+            ).get("Item")
+            if not item:
+                return self.claim(key, expires)
+            response = item.get("response", {}).get("S")
+            return {
+                "response": json.loads(response) if response else None,
+                "expires": int(item["expires"]["N"]),
+            }
+
+    def complete(self, key, response, expires):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                "id": {"S": key},
+                "response": {"S": json.dumps(response)},
+                "expires": {"N": str(int(expires))},
+            },
+        )
+
+    def release(self, key):
+        self.client.delete_item(TableName=self.table_name, Key={"id": {"S": key}})
+
+
+BACKENDS = {
+    "memory": MemoryStore,
+    "sqlite": SqliteStore,
+    "dynamodb": DynamoDbStore,
+}
+
+_store = Backend(BACKENDS, IDEMPOTENCY_BACKEND)
+
+
+def get_store():
+    return _store.get()
+
+
+def request_key(scope, ticket, body):
+    digest = hashlib.sha256(
+        json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"{scope}:{ticket}:{digest}"
+
+
+def claim(key):
+    """
+    Claim one item of a fan-out (an S3 object, an attachment) for this
+    delivery. Returns `False` when the item was completed, or is being
+    processed, by an earlier delivery.
+    """
+    if IDEMPOTENCY_WINDOW <= 0:
+        return True
+    existing = get_store().claim(key, time.time() + IDEMPOTENCY_WINDOW)
+    if existing is not None:
+        logger.info("Item already processed: %s", key)
+    return existing is None
+
+
+def complete(key):
+    if IDEMPOTENCY_WINDOW > 0:
+        get_store().complete(key, [200, {"ok": True}], time.time() + IDEMPOTENCY_WINDOW)
+
+
+def release(key):
+    if IDEMPOTENCY_WINDOW > 0:
+        get_store().release(key)
+
+
+def run_once(key, func):
+    """
+    Return `func()` (a `(status, resp)` pair) for the first delivery of `key`
+    and the stored pair for duplicates within the window. A duplicate which
+    arrives while the first delivery is still running gets a 409.
+    """
+    if IDEMPOTENCY_WINDOW <= 0:
+        return func()
+    store = get_store()
+    existing = store.claim(key, time.time() + IDEMPOTENCY_WINDOW)
+    if existing is not None:
+        logger.info("Duplicate request: %s", key)
+        if existing["response"] is None:
+            return 409, {
+                "ok": False,
+                "error": "Duplicate request is still being processed",
+            }
+        status, resp = existing["response"]
+        return status, resp
+    try:
+        status, resp = func()
+    except Exception:
+        # Let a retry of a failed delivery through
+        store.release(key)
+        raise
+    store.complete(key, [status, resp], time.time() + IDEMPOTENCY_WINDOW)
+    return status, resp
@@ -1,23 +1,17 @@
 import copy
 import json
-import logging
 import os
 import re
 
-import boto3
-
 from clients.jsd import get_request, update_issue
-from clients.snow import create_incident, update_incident
-from settings import Parameters, get_log_level
-
-logger = logging.getLogger()
-logger.setLevel(get_log_level())
-
-
-def get_param_value(name):
-    client = boto3.client("ssm")
-    parameter = client.get_parameter(Name=name, WithDecryption=True)
-    return parameter["Parameter"]["Value"]
+from clients.snow import ClientError, create_incident, update_incident
+from idempotency import request_key, run_once
+from links import incident_for, link
+from log_cfg import Json, bind_invocation, logger
+from metrics import instrument_handler
+from mapping import TRUTHY, Field, Mapping
+from queues import get_queue
+from settings import ASYNC_MODE, QUEUE_BATCH_SIZE, Parameters
 
 
 def get_request(issue_id):
@@ -78,6 +72,11 @@ allowed_fields = {
 }
 
 
+put_extra_fields = {
+    "comment": validate_comment,
+}
+
+
 def validate_body(body, extra_fields=None, all_fields=True):
     all_allowed_fields = copy.copy(allowed_fields)
     if extra_fields:
@@ -113,85 +112,79 @@ def validate_body(body, extra_fields=None, all_fields=True):
     return 400 if error else 200, resp
 
 
+URGENCY_BY_SEVERITY = {
+    "Severity 4": "4 - Low",
+    "Severity 5": "4 - Low",
+}
+DEFAULT_IMPACT = "3 - Medium"
+DEFAULT_URGENCY = "3 - Medium"
+
+POST_MAPPING = Mapping([
+    Field("callingSystem", const="FINEOS-SERVICE-DESK"),
+    Field("state", const="Active"),
+    Field("reportedSource", const="FINEOS"),
+    Field("category", const="Application"),
+    Field("subCategory", const="Failure"),
+    Field("configurationItem", const="11835"),
+    Field("impact", const=DEFAULT_IMPACT),
+    Field("urgency", "fields.priority.name", default=None,
+          translate=URGENCY_BY_SEVERITY, translate_default=DEFAULT_URGENCY),
+    Field("contactType", const="Vendor referral"),
+    Field("caller", const="FINEOS SERVICE DESK"),
+    Field("callerNumber", const="1-899-898989"),
+    Field("shortDescription", "fields.summary", default=None),
+    Field("description", "fields.description", default=""),
+    Field("assignedTo", const=""),
+    Field("vendorTicketNumber", "key", default=None),
+])
+
+PUT_MAPPING = Mapping([
+    Field("callingSystem", const="FINEOS-SERVICE-DESK"),
+    Field("impact", const=DEFAULT_IMPACT, when=TRUTHY, guard="fields.priority"),
+    Field("urgency", "fields.priority.name", default=None, when=TRUTHY, guard="fields.priority",
+          translate=URGENCY_BY_SEVERITY, translate_default=DEFAULT_URGENCY),
+    Field("shortDescription", "fields.summary", when=TRUTHY),
+    Field("description", "fields.description", when=TRUTHY),
+    Field("workNotes", "fields.comment", when=TRUTHY),
+])
+
+
 def post_mapping(body):
-    fields = body.get("fields", {})
-    impact = "3 - Medium"
-    urgency = "3 - Medium"
-    if fields.get("priority", {}).get("name") in ("Severity 4", "Severity 5"):
-        urgency = "4 - Low"
-    incident = {
-        "callingSystem": "FINEOS-SERVICE-DESK",
-        "state": "Active",
-        "reportedSource": "FINEOS",
-        "category": "Application",
-        "subCategory": "Failure",
-        "configurationItem": "11835",
-        "impact": impact,
-        "urgency": urgency,
-        "contactType": "Vendor referral",
-        "caller": "FINEOS SERVICE DESK",
-        "callerNumber": "1-899-898989",
-        "shortDescription": fields.get("summary"),
-        "description": fields.get("description", ""),
-        "assignedTo": "",
-        "vendorTicketNumber": body.get("key"),
-    }
-    return incident
+    return POST_MAPPING(body)
 
 
 def put_mapping(body):
-    incident = {
-        "callingSystem": "FINEOS-SERVICE-DESK",
-    }
-    fields = body.get("fields", {})
-    priority = fields.get("priority", {})
-    if priority:
-        impact = "3 - Medium"
-        urgency = "3 - Medium"
-        if priority.get("name") in ("Severity 4", "Severity 5"):
-            urgency = "4 - Low"
-        incident["impact"] = impact
-        incident["urgency"] = urgency
-    if fields.get("summary"):
-        incident["shortDescription"] = fields.get("summary")
-    if fields.get("description"):
-        incident["description"] = fields.get("description", "")
-    if fields.get("comment"):
-        incident["workNotes"] = fields.get("comment", "")
-    return incident
+    return PUT_MAPPING(body)
 
 
 def create_snow_incident(body):
-    logger.debug("Creating a SNOW incident: %s", body)
+    logger.debug("Creating a SNOW incident: %s", Json(body))
     resp = create_incident(body)
-    logger.debug("SNOW response: %s", resp)
+    logger.debug("SNOW response: %s", Json(resp))
     return resp["number"]
 
 
 def update_snow_incident(incident_id, body):
-    logger.debug("Updating a SNOW incident: [%s] %s", incident_id, body)
+    logger.debug("Updating a SNOW incident: [%s] %s", incident_id, Json(body))
     resp = update_incident(incident_id, body)
-    logger.debug("SNOW response: %s", resp)
+    logger.debug("SNOW response: %s", Json(resp))
 
 
 def update_jsd_request(issue_id, snow_incident_number):
     data = {
         "fields": {},
     }
-    custom_field_id = get_param_value(Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID.value)
+    custom_field_id = Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID.get()
     data["fields"][custom_field_id] = str(snow_incident_number)
     update_issue(issue_id, data)
 
 
 def put_request_handler(incident_id, body):
-    logger.debug("PUT HTTP request received, validating body: %s", body)
+    logger.debug("PUT HTTP request received, validating body: %s", Json(body))
 
     # Validation
-    extra_fields = {
-        "comment": validate_comment,
-    }
     status, resp = validate_body(
-        body, extra_fields=extra_fields, all_fields=False)
+        body, extra_fields=put_extra_fields, all_fields=False)
     if status != 200:
         logger.debug("Body validation failed: %s", resp["error"])
         return status, resp
@@ -200,7 +193,7 @@ def put_request_handler(incident_id, body):
 
     # Mapping
     body = put_mapping(body)
-    logger.debug("PUT body after mapping: %s", json.dumps(body))
+    logger.debug("PUT body after mapping: %s", Json(body))
 
     # Updating SNOW incident
     update_snow_incident(incident_id, body)
@@ -209,7 +202,7 @@ def put_request_handler(incident_id, body):
 
 
 def post_request_handler(body):
-    logger.debug("POST HTTP request received, validating body: %s", body)
+    logger.debug("POST HTTP request received, validating body: %s", Json(body))
 
     # Validation
     status, resp = validate_body(body)
@@ -221,11 +214,17 @@ def post_request_handler(body):
 
     # Mapping
     body = post_mapping(body)
-    logger.debug("POST body after mapping: %s", json.dumps(body))
+    logger.debug("POST body after mapping: %s", Json(body))
 
-    # Creating a SNOW incident
-    incident_number = create_snow_incident(body)
-    logger.debug("SNOW incident created: %s", incident_number)
+    # Creating a SNOW incident, unless a delivery of the same issue already
+    # did; the JSD request is updated again in case that delivery failed
+    incident_number = incident_for(body["vendorTicketNumber"])
+    if incident_number:
+        logger.info("JSD issue %s is already linked to %s", body["vendorTicketNumber"], incident_number)
+    else:
+        incident_number = create_snow_incident(body)
+        logger.debug("SNOW incident created: %s", incident_number)
+        link(incident_number, body["vendorTicketNumber"])
 
     # Update JSD incident
     update_jsd_request(body["vendorTicketNumber"], incident_number)
@@ -240,7 +239,7 @@ def validate_event(event):
     error = None
 
     headers = event.get("headers", {})
-    logger.debug("Headers: %s", json.dumps(headers))
+    logger.debug("Headers: %s", Json(headers))
 
     content_type_name = "content-type"
     content_type_value = None
@@ -273,18 +272,57 @@ def validate_event(event):
     return status, resp, body
 
 
+def enqueue_request(method, incident_id, body):
+    """
+    Validate the body and queue it for `worker_handler`.
+    """
+    if method == "POST":
+        status, resp = validate_body(body)
+    else:
+        status, resp = validate_body(
+            body, extra_fields=put_extra_fields, all_fields=False)
+    if status != 200:
+        return status, resp
+    get_queue().send({
+        "method": method,
+        "incidentId": incident_id,
+        "body": body,
+    })
+    resp["queued"] = True
+    return 202, resp
+
+
+def dispatch(method, incident_id, body):
+    if ASYNC_MODE:
+        return enqueue_request(method, incident_id, body)
+    if method == "POST":
+        return post_request_handler(body)
+    return put_request_handler(incident_id, body)
+
+
+def process_message(message):
+    if message["method"] == "POST":
+        return post_request_handler(message["body"])
+    return put_request_handler(message["incidentId"], message["body"])
+
+
+@instrument_handler
 def handler(event, context):
-    print("Event: {}".format(json.dumps(event)))
-    logger.debug("Event: %s", json.dumps(event))
+    bind_invocation(context)
+    logger.debug("Event: %s", Json(event))
     logger.info("HTTP request received, validating...")
     status, resp, body = validate_event(event)
     if resp["ok"]:
         method = event.get("httpMethod")
+        incident_id = (event.get("pathParameters") or {}).get("incidentId")
         if method == "POST":
-            status, resp = post_request_handler(body)
-        elif method == "PUT":
-            incident_id = event.get("pathParameters", {}).get("incidentId")
-            status, resp = put_request_handler(incident_id, body)
+            ticket = body.get("key") if isinstance(body, dict) else None
+        else:
+            ticket = incident_id
+        # Jira retries webhooks, identical deliveries get the first response
+        status, resp = run_once(
+            request_key(f"jira-{method}", ticket, body),
+            lambda: dispatch(method, incident_id, body))
     return {
         "isBase64Encoded": False,
         "statusCode": status,
@@ -292,3 +330,46 @@ def handler(event, context):
         "multiValueHeaders": {},
         "body": json.dumps(resp),
     }
+
+
+@instrument_handler
+def worker_handler(event, context):
+    """
+    Process queued requests. Invoked by the SQS event source with a batch of
+    `Records`; without records it pulls one batch from the configured queue
+    (local runs). Validation errors and requests rejected by ServiceNow are
+    final, any other failure is retried.
+    """
+    bind_invocation(context)
+    if "Records" in event:
+        failures = []
+        for record in event["Records"]:
+            try:
+                status, resp = process_message(json.loads(record["body"]))
+                if status != 200:
+                    logger.error("Dropping queued request: %s", resp.get("error"))
+            except ClientError as ex:
+                logger.error("Dropping queued request rejected by SNOW: %s", str(ex))
+            except Exception as ex:
+                logger.error("Queued request failed: %s", str(ex))
+                failures.append({"itemIdentifier": record["messageId"]})
+        return {"batchItemFailures": failures}
+
+    queue = get_queue()
+    processed = 0
+    failed = 0
+    for receipt, message in queue.receive(QUEUE_BATCH_SIZE):
+        try:
+            status, resp = process_message(message)
+            if status != 200:
+                logger.error("Dropping queued request: %s", resp.get("error"))
+            queue.delete(receipt)
+            processed += 1
+        except ClientError as ex:
+            logger.error("Dropping queued request rejected by SNOW: %s", str(ex))
+            queue.delete(receipt)
+            failed += 1
+        except Exception as ex:
+            logger.error("Queued request failed: %s", str(ex))
+            failed += 1
+    return {"processed": processed, "failed": failed}
@@ -1,33 +1,29 @@
 import json
-import boto3
 import os
 import sys
-import requests
-from log_cfg import logger
+import attachment_refs
+import idempotency
+from log_cfg import Json, bind_invocation, logger
+from metrics import instrument_handler
 from urllib.parse import unquote_plus
-from requests.auth import HTTPBasicAuth
-from aws.ssm import get_ssm_value
-from settings import Parameters
-
-s3_client = boto3.client('s3')
+from aws import s3
+from aws.ssm import get_ssm_values
+from clients import jsd
+from links import incident_for
+from settings import ATTACHMENT_DEADLINE, WORKER_POOL_SIZE, Parameters
+from workers import (DeadlineExceeded, current_deadline, host_slot, map_bounded, start_deadline,
+                     transfer_estimate)
 
 
 S3_JSD_BUCKET = os.environ['S3_JSD_BUCKET']
 
-JIRA_SEVER = None
-JIRA_USER = None
-JIRA_API_KEY = None
-
 
 def validate_environment():
-    error = ''
-    global JIRA_SEVER, JIRA_USER, JIRA_API_KEY
-    err, JIRA_SEVER = get_ssm_value(key=Parameters.JIRA_HOST.value)
-    error += err
-    err, JIRA_USER = get_ssm_value(key=Parameters.JIRA_USER_ID.value)
-    error += err
-    err, JIRA_API_KEY = get_ssm_value(key=Parameters.JIRA_APP_PASSWORD.value)
-    error += err
+    error, _ = get_ssm_values([
+        Parameters.JIRA_HOST.value,
+        Parameters.JIRA_USER_ID.value,
+        Parameters.JIRA_APP_PASSWORD.value,
+    ])
 
     resp = {
         "ok": not error,
@@ -39,47 +35,122 @@ def validate_environment():
     return 500 if error else 200, resp
 
 def download_file_and_upload_to_s3(file_name,attachment_id,customer_ref_no):
-    msg = None
-    logger.debug('Uploading attachment to s3 {}'.format(attachment_id))
-    try:
-        url = f'{JIRA_SEVER}/secure/attachment/{attachment_id}/{file_name}'
-        download_path = f'/tmp/{attachment_id}/{file_name}'
-        os.makedirs(os.path.dirname(download_path), exist_ok=True)
-        with open(download_path, 'wb') as out:
-            response = requests.get(url, auth=(JIRA_USER, JIRA_API_KEY), stream=True)
-            out.write(response.content)
-        with open(download_path, 'rb') as data:
-            s3_client.upload_fileobj(data, S3_JSD_BUCKET, f'{customer_ref_no}/{attachment_id}/{file_name}')
-        msg = f'Uploaded {file_name}'
-    except Exception as ex:
-        msg = f'Failed to upload {file_name}: {str(ex)}'
+    logger.debug('Uploading attachment to s3 %s', attachment_id)
+    # Pipe the HTTP body straight into a multipart upload
+    with host_slot(jsd.get_api_url()), jsd.open_attachment(attachment_id, file_name) as response:
+        response.raw.decode_content = True
+        s3.upload_stream(response.raw, S3_JSD_BUCKET, f'{customer_ref_no}/{attachment_id}/{file_name}')
+    msg = f'Uploaded {file_name}'
     logger.debug(msg)
     return msg
 
+def copy_attachments(attachments, customer_ref_no):
+    """
+    Copy `(file_name, attachment_id)` pairs to S3 concurrently.
+
+    Returns one message per attachment, in the same order, and the file
+    names left for a retry: those not started or not finished before the
+    deadline. Attachments copied by an earlier delivery are skipped.
+    """
+    claim_keys = [f'jsd_to_s3:{customer_ref_no}:{attachment_id}' for _, attachment_id in attachments]
+    claimed = []
+    try:
+        for claim_key in claim_keys:
+            claimed.append(idempotency.claim(claim_key))
+    except Exception:
+        for claim_key, ok in zip(claim_keys, claimed):
+            if ok:
+                idempotency.release(claim_key)
+        raise
+    results = map_bounded(
+        lambda attachment: download_file_and_upload_to_s3(attachment[0], attachment[1], customer_ref_no),
+        [attachment for attachment, ok in zip(attachments, claimed) if ok],
+        max_workers=WORKER_POOL_SIZE,
+        timeout=ATTACHMENT_DEADLINE,
+        deadline=current_deadline(),
+        # Sizes are unknown until the download starts
+        estimate=lambda attachment: transfer_estimate(0),
+    )
+    results = iter(results)
+    msgs = []
+    leftover = []
+    for (file_name, _), claim_key, ok in zip(attachments, claim_keys, claimed):
+        if not ok:
+            msgs.append(f'Skipped {file_name}: already uploaded')
+            continue
+        msg, ex = next(results)
+        if ex is None:
+            idempotency.complete(claim_key)
+        else:
+            # Copies still running at the deadline are frozen with the
+            # invocation, so they are retried like those not started
+            idempotency.release(claim_key)
+            if isinstance(ex, DeadlineExceeded):
+                leftover.append(file_name)
+            msg = f'Failed to upload {file_name}: {str(ex)}'
+            logger.error(msg)
+        msgs.append(msg)
+    return msgs, leftover
+
+
+def leftover_response(resp, leftover):
+    """
+    Turn `resp` into a 503 listing the attachments left for a retry of the
+    webhook; the others are skipped then.
+    """
+    resp["ok"] = False
+    resp["error"] = f'Deadline reached, {len(leftover)} attachments left for a retry'
+    resp["retry"] = leftover
+    logger.error(resp["error"])
+    return 503, resp
+
+def resolve_comment_attachments(issue_key, body):
+    """
+    Return the `(file_name, attachment_id)` pairs a comment refers to,
+    checked against the issue's attachments: a link to an attachment of
+    another issue is ignored. A file name attached several times resolves
+    to the latest.
+    """
+    refs = attachment_refs.parse(body)
+    if not refs:
+        return []
+    names = {}
+    by_name = {}
+    data = jsd.get_issue(issue_key, fields='attachment')
+    for item in data['fields']['attachment']:
+        names[item['id']] = item['filename']
+        latest = by_name.get(item['filename'])
+        if latest is None or int(item['id']) > int(latest):
+            by_name[item['filename']] = item['id']
+    attachments = []
+    for attachment_id in refs.ids:
+        if attachment_id in names:
+            attachments.append((names[attachment_id], attachment_id))
+        else:
+            logger.info('Attachment %s does not belong to %s, skipped', attachment_id, issue_key)
+    for file_name in refs.names:
+        if file_name in by_name:
+            attachments.append((file_name, by_name[file_name]))
+    return attachments
+
+
 def download_comment_attachments_and_upload_to_s3(issue_key, body,customer_ref_no):
     error = None
     logger.debug('Handling attachments in comment...')
 
-    headers = {
-        "Accept" : "application/json"
-    }
     resp = {
         "ok": not error,
     }
     try:
-        auth = HTTPBasicAuth(JIRA_USER, JIRA_API_KEY)
-        response = requests.request(method='GET',url=f'{JIRA_SEVER}/rest/api/3/issue/{issue_key}?fields=attachment',headers=headers,auth=auth)
-        
-        data = json.loads(response.text)
-
-        attachments = [item for item in data['fields']['attachment'] if item['filename'] in body]
+        attachments = resolve_comment_attachments(issue_key, body)
         msgs = []
         if not attachments:
             msgs.append('No attachemnt matched')
         else:
-            for attachment in attachments:
-                msg = download_file_and_upload_to_s3(attachment['filename'], attachment['id'],customer_ref_no)
-                msgs.append(msg)
+            msgs, leftover = copy_attachments(attachments, customer_ref_no)
+            if leftover:
+                resp["info"] = msgs
+                return leftover_response(resp, leftover)
         resp["info"] = msgs
     except Exception as ex:
         error = f"An error occurred: {str(ex)}"
@@ -97,14 +168,15 @@ def upload_to_s3(body, customer_ref_no):
         "ok": not error,
     }
     msgs = []
+    leftover = []
     if not attachments:
         msgs.append('No attachemnt found')
     else:
-        for attachment in attachments:
-            msg = download_file_and_upload_to_s3(attachment['fileName'], attachment['attachmentId'],customer_ref_no)
-            msgs.append(msg)
+        msgs, leftover = copy_attachments([(attachment['fileName'], attachment['attachmentId']) for attachment in attachments], customer_ref_no)
     resp["info"] = msgs
-    return resp
+    if leftover:
+        return leftover_response(resp, leftover)
+    return 200, resp
 
 def validate_body(body):
     error = None
@@ -114,7 +186,8 @@ def validate_body(body):
         error = "`body` is absent or empty: {}".format(body)
     else:
         issue_key = body.get("issueKey")
-        customer_ref_no = body.get('customerRefNo')
+        # The SNOW incident linked to the issue when the webhook omits it
+        customer_ref_no = body.get('customerRefNo') or incident_for(issue_key)
         if not issue_key:
             error = "`issueKey` is empty"
         elif not customer_ref_no:
@@ -154,11 +227,14 @@ def validate_event(event):
         logger.error(error)
     return status, resp, body
 
+@instrument_handler
 def handler(event, context):
     """
     Upload attachments from JSD to S3
     """
-    logger.debug("Event: %s", json.dumps(event))
+    bind_invocation(context)
+    start_deadline(context)
+    logger.debug("Event: %s", Json(event))
     logger.info("HTTP request received, validating...")
 
     status, resp, body = validate_event(event)
@@ -170,7 +246,7 @@ def handler(event, context):
                 if 'commentId' in body:
                     status, resp = download_comment_attachments_and_upload_to_s3(issue_key,body['body'],customer_ref_no)
                 else:
-                    resp = upload_to_s3(body,customer_ref_no)
+                    status, resp = upload_to_s3(body,customer_ref_no)
     return {
         "statusCode": status,
         "body": json.dumps(resp)
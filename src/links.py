@@ -0,0 +1,146 @@
+"""
+Index of the links between ServiceNow incidents and Jira issues.
+
+A link is stored twice, once per direction (`snow:<incident number>` and
+`jira:<issue key>` items holding the counterpart), so that either side is
+found with a single key lookup instead of a REST call or a JQL search. The
+processors record a link whenever they create a ticket or receive both
+numbers.
+
+`get_index()` returns the backend selected by `LinkBackend` (`dynamodb`,
+`sqlite` or `memory`, see `backends`). The index is an optimization:
+failing lookups and writes are logged and treated as misses.
+"""
+import logging
+import sqlite3
+import threading
+
+import boto3
+from backends import Backend
+from settings import LINK_BACKEND, LINK_PATH, LINK_TABLE
+
+logger = logging.getLogger()
+
+SNOW = "snow"
+JIRA = "jira"
+
+
+def item_id(system, ticket):
+    return f"{system}:{ticket}"
+
+
+class MemoryIndex:
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def put(self, items):
+        with self.lock:
+            self.items.update(items)
+
+    def get(self, key):
+        with self.lock:
+            return self.items.get(key)
+
+
+class SqliteIndex:
+    def __init__(self, path=LINK_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS links ("
+                "id TEXT PRIMARY KEY, counterpart TEXT NOT NULL)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def put(self, items):
+        with self.lock, self.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO links (id, counterpart) VALUES (?, ?)",
+                list(items.items()))
+
+    def get(self, key):
+        with self.lock, self.connect() as conn:
+            row = conn.execute("SELECT counterpart FROM links WHERE id = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+class DynamoDbIndex:
+    """
+    Items are `{id, counterpart}`; both directions of a link are written
+    with one `BatchWriteItem` call.
+    """
+
+    def __init__(self, table_name=LINK_TABLE):
+        self.table_name = table_name
+        self.client = boto3.client('dynamodb')
+
+    def put(self, items):
+        requests = [
+            {"PutRequest": {"Item": {"id": {"S": key}, "counterpart": {"S": value}}}}
+            for key, value in items.items()
+        ]
+        while requests:
+            resp = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            requests = resp.get("UnprocessedItems", {}).get(self.table_name, [])
+
+    def get(self, key):
+        item = self.client.get_item(
+            TableName=self.table_name, Key={"id": {"S": key}}).get("Item")
+        return item["counterpart"]["S"] if item else None
+
+
+BACKENDS = {
+    "memory": MemoryIndex,
+    "sqlite": SqliteIndex,
+    "dynamodb": DynamoDbIndex,
+}
+
+_index = Backend(BACKENDS, LINK_BACKEND)
+
+
+def get_index():
+    return _index.get()
+
+
+def link(incident_number, issue_key):
+    """
+    Record that SNOW incident `incident_number` and Jira issue `issue_key`
+    are the same ticket.
+    """
+    if not incident_number or not issue_key:
+        return
+    incident_number, issue_key = str(incident_number), str(issue_key)
+    try:
+        get_index().put({
+            item_id(SNOW, incident_number): issue_key,
+            item_id(JIRA, issue_key): incident_number,
+        })
+    except Exception as ex:
+        logger.warning("Could not link %s and %s: %s", incident_number, issue_key, ex)
+
+
+def _lookup(system, ticket):
+    if not ticket:
+        return None
+    try:
+        return get_index().get(item_id(system, ticket))
+    except Exception as ex:
+        logger.warning("Link lookup of %s failed: %s", ticket, ex)
+        return None
+
+
+def issue_for(incident_number):
+    """
+    Return the Jira issue key linked to a SNOW incident, or `None`.
+    """
+    return _lookup(SNOW, incident_number)
+
+
+def incident_for(issue_key):
+    """
+    Return the SNOW incident number linked to a Jira issue, or `None`.
+    """
+    return _lookup(JIRA, issue_key)
@@ -1,23 +1,129 @@
+import json
 import logging
 import os
+import random
+import re
 import sys
+import traceback
 from settings import get_log_level
 """
 All lambda methods use this loging config.
 Provides a single place where all log config/level/formatting is setup so that one
-can see source file, line numbers, and any other desired log fields. 
+can see source file, line numbers, and any other desired log fields.
+
+Records are written as one JSON object per line. Arguments are only
+formatted when a record is actually emitted, so `Json(value)` is the way to
+log a payload: it is serialized (redacted and truncated) at that point, and
+not at all when the level is disabled. Debug logging is sampled per
+invocation, see `bind_invocation`.
 """
 
+# Longest string kept in a `Json` payload and longest message, in characters
+MAX_FIELD_LENGTH = int(os.environ.get('LogMaxFieldLength', '1000'))
+MAX_MESSAGE_LENGTH = int(os.environ.get('LogMaxMessageLength', '4000'))
+# Share of invocations logged at DEBUG when `LogLevel` is DEBUG; the others
+# log at INFO
+DEBUG_SAMPLE_RATE = float(os.environ.get('LogDebugSampleRate', '1'))
+
+REDACTED = '***'
+SECRET_KEY = re.compile(
+    r'pass|secret|token|authorization|^auth(?:[_-]|$)|api[-_]?key|credential|signature|cookie', re.I)
+SECRET_TEXT = [
+    (re.compile(r'\b(Bearer|Basic)\s+[A-Za-z0-9._~+/=-]+'), r'\1 ' + REDACTED),
+    (re.compile(
+        r'((?:password|secret|token|api[-_]?key)["\']?\s*[:=]\s*["\']?)[^"\'\s,}&]+', re.I),
+     r'\1' + REDACTED),
+]
+
+LOG_LEVEL = get_log_level()
+
+_request_id = None
+
+
+def truncate(text, limit=MAX_FIELD_LENGTH):
+    if len(text) <= limit:
+        return text
+    return f'{text[:limit]}...({len(text) - limit} more chars)'
+
+
+def redact_text(text):
+    for pattern, replacement in SECRET_TEXT:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def scrub(value):
+    """
+    Return a copy of `value` with secret-looking keys redacted and long
+    strings truncated.
+    """
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if isinstance(key, str) and SECRET_KEY.search(key) and value[key]
+            else scrub(value[key])
+            for key in value
+        }
+    if isinstance(value, (list, tuple)):
+        return [scrub(item) for item in value]
+    if isinstance(value, (bytes, bytearray)):
+        return f'<{len(value)} bytes>'
+    if isinstance(value, str):
+        return truncate(value)
+    return value
+
+
+class Json:
+    """
+    Log argument serialized only when the record is emitted.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(scrub(self.value), default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'location': f'{record.filename}:{record.lineno}',
+            'thread': record.thread,
+            'message': truncate(redact_text(record.getMessage()), MAX_MESSAGE_LENGTH),
+        }
+        if _request_id:
+            entry['request_id'] = _request_id
+        if record.exc_info:
+            entry['exception'] = truncate(redact_text(
+                ''.join(traceback.format_exception(*record.exc_info))), MAX_MESSAGE_LENGTH)
+        return json.dumps(entry, default=str)
+
+
+def bind_invocation(context=None):
+    """
+    Tag the following records with the invocation's request id and decide
+    whether this invocation logs at DEBUG. Call at the top of a handler.
+    """
+    global _request_id
+    _request_id = getattr(context, 'aws_request_id', None)
+    level = LOG_LEVEL
+    if level == logging.DEBUG and random.random() >= DEBUG_SAMPLE_RATE:
+        level = logging.INFO
+    logger.setLevel(level)
+
+
 logger = logging.getLogger()
-for h in logger.handlers:
+for h in list(logger.handlers):
     logger.removeHandler(h)
 h = logging.StreamHandler(sys.stdout)
-# use whatever format you want here
-FORMAT = '%(asctime)-15s %(process)d-%(thread)d %(name)s [%(filename)s:%(lineno)d] :%(levelname)8s: %(message)s'
-h.setFormatter(logging.Formatter(FORMAT))
+h.setFormatter(JsonFormatter())
 logger.addHandler(h)
-logger.setLevel(get_log_level())
+logger.setLevel(LOG_LEVEL)
 # Suppress the more verbose modules
 logging.getLogger('__main__').setLevel(logging.DEBUG)
 logging.getLogger('botocore').setLevel(logging.WARN)
-
+logging.getLogger('boto3').setLevel(logging.WARN)
+logging.getLogger('urllib3').setLevel(logging.WARN)
@@ -0,0 +1,297 @@
+"""
+Table-driven field mapping.
+
+A mapping is a list of `Field` rules. On first use, the `Parameters` they
+reference (custom field IDs and the like) are resolved from SSM with one
+batched lookup, and every rule is turned into a closure doing only the steps
+its field uses, with its paths split up front. Constants of top-level fields
+are gathered into a template dict copied for each record.
+"""
+import copy
+import threading
+
+from settings import Parameters
+
+MISSING = object()
+EMPTY = {}
+
+ALWAYS = "always"
+PRESENT = "present"
+TRUTHY = "truthy"
+
+
+def _reader(path, default=MISSING):
+    """
+    Return a function reading input `path`, a dotted path or a callable
+    taking the whole input; missing or empty parents read as empty dicts.
+    """
+    if callable(path):
+        return path
+    *parents, key = path.split(".")
+    if not parents:
+        return lambda data: data.get(key, default)
+    if len(parents) == 1:
+        parent, = parents
+        return lambda data: (data.get(parent) or EMPTY).get(key, default)
+
+    def read(data):
+        for parent in parents:
+            data = data.get(parent) or EMPTY
+        return data.get(key, default)
+    return read
+
+
+class Field:
+    """
+    One output field.
+
+    :param target: dotted output path (`requestFieldValues.summary`) or a
+        tuple of parts; a `Parameters` part (e.g. a custom field ID) is
+        resolved to its SSM value
+    :param source: dotted input path, or a callable taking the whole input
+        (its result is always emitted)
+    :param const: emit this value instead of the source value; a
+        `Parameters` member is resolved to its SSM value
+    :param default: value used when the source is missing; without it the
+        field is left out
+    :param when: `always`, `present` (the checked value exists) or `truthy`
+    :param guard: dotted input path checked by `when` instead of `source`;
+        required for conditional constants
+    :param translate: table applied to the value
+    :param translate_default: value for inputs not in `translate`
+        (unknown values are passed through otherwise)
+    :param transform: callable applied last
+    """
+
+    def __init__(self, target, source=None, const=MISSING, default=MISSING,
+                 when=ALWAYS, guard=None, translate=None,
+                 translate_default=MISSING, transform=None):
+        if when not in (ALWAYS, PRESENT, TRUTHY):
+            raise ValueError(f"Unknown `when`: {when}")
+        if const is not MISSING and when != ALWAYS and not guard:
+            raise ValueError("A conditional constant needs a `guard`")
+        if isinstance(target, str):
+            target = target.split(".")
+        elif isinstance(target, Parameters):
+            target = (target,)
+        self.target = tuple(target)
+        self.source = source
+        self.const = const
+        self.default = default
+        self.when = when
+        self.guard = guard
+        self.translate = translate
+        self.translate_default = translate_default
+        self.transform = transform
+
+
+def _post(field):
+    """
+    Return the function applying the `translate` and `transform` steps of
+    `field` to a value, or `None` when it has neither.
+    """
+    table, fallback, transform = field.translate, field.translate_default, field.transform
+    if table is None:
+        return transform
+    if fallback is MISSING:
+        translate = lambda value: table.get(value, value)
+    else:
+        translate = lambda value: table.get(value, fallback)
+    if transform is None:
+        return translate
+    return lambda value: transform(translate(value))
+
+
+def _rule(field, target, const):
+    """
+    Return a function setting output `target` of `field` from an input
+    record; the guard of the field is checked by the caller. Top-level
+    fields read from an input path get a single closure walking the path
+    itself.
+    """
+    *parents, key = target
+    post = _post(field) if const is MISSING else None
+    if const is MISSING and not parents and not callable(field.source):
+        return _path_rule(field, key, post)
+
+    if const is not MISSING:
+        if isinstance(const, (dict, list)):
+            get = lambda data: copy.deepcopy(const)
+        elif not parents:
+            def apply(data, out):
+                out[key] = const
+            return apply
+        else:
+            get = lambda data: const
+        keep = lambda value: True
+    elif field.when == TRUTHY and not field.guard:
+        get = _reader(field.source, None)
+        keep = bool
+    else:
+        get = _reader(field.source, field.default if field.when == ALWAYS or field.guard else MISSING)
+        keep = lambda value: value is not MISSING
+
+    def apply(data, out):
+        value = get(data)
+        if keep(value):
+            for parent in parents:
+                out = out.setdefault(parent, {})
+            out[key] = value if post is None else post(value)
+    return apply
+
+
+def _path_rule(field, key, post):
+    *sources, name = field.source.split(".")
+    if field.when == TRUTHY and not field.guard:
+        if post is None:
+            def apply(data, out):
+                for source in sources:
+                    data = data.get(source) or EMPTY
+                value = data.get(name)
+                if value:
+                    out[key] = value
+        else:
+            def apply(data, out):
+                for source in sources:
+                    data = data.get(source) or EMPTY
+                value = data.get(name)
+                if value:
+                    out[key] = post(value)
+        return apply
+
+    default = field.default if field.when == ALWAYS or field.guard else MISSING
+    if default is not MISSING:
+        if post is None:
+            def apply(data, out):
+                for source in sources:
+                    data = data.get(source) or EMPTY
+                out[key] = data.get(name, default)
+        else:
+            def apply(data, out):
+                for source in sources:
+                    data = data.get(source) or EMPTY
+                out[key] = post(data.get(name, default))
+    elif post is None:
+        def apply(data, out):
+            for source in sources:
+                data = data.get(source) or EMPTY
+            value = data.get(name, MISSING)
+            if value is not MISSING:
+                out[key] = value
+    else:
+        def apply(data, out):
+            for source in sources:
+                data = data.get(source) or EMPTY
+            value = data.get(name, MISSING)
+            if value is not MISSING:
+                out[key] = post(value)
+    return apply
+
+
+def _guarded(guard, when, template, rules):
+    """
+    Return a function setting the constants of `template` and applying
+    `rules` when input `guard` passes `when`.
+    """
+    *sources, name = guard.split(".")
+    if when == TRUTHY:
+        def apply(data, out):
+            checked = data
+            for source in sources:
+                checked = checked.get(source) or EMPTY
+            if checked.get(name):
+                out.update(template)
+                for rule in rules:
+                    rule(data, out)
+    else:
+        def apply(data, out):
+            checked = data
+            for source in sources:
+                checked = checked.get(source) or EMPTY
+            if name in checked:
+                out.update(template)
+                for rule in rules:
+                    rule(data, out)
+    return apply
+
+
+def _build(entries, targets, checked=False):
+    """
+    Return the `(template, rules)` of resolved `(field, target, const)`
+    entries. Constants of top-level targets set by no other field go to the
+    template dict; consecutive fields sharing a guard become one rule
+    checking it, unless the guard is already `checked`.
+    """
+    template = {}
+    rules = []
+    group = None
+    for field, target, const in entries:
+        if field.guard and field.when != ALWAYS and not checked:
+            test = (field.guard, field.when)
+            if group is None or group[0] != test:
+                group = (test, [])
+                rules.append(group)
+            group[1].append((field, target, const))
+            continue
+        group = None
+        if (len(target) == 1 and const is not MISSING
+                and not isinstance(const, (dict, list)) and targets.count(target) == 1):
+            template[target[0]] = const
+        else:
+            rules.append(_rule(field, target, const))
+    for index, rule in enumerate(rules):
+        if isinstance(rule, tuple):
+            (guard, when), grouped = rule
+            rules[index] = _guarded(guard, when, *_build(grouped, targets, checked=True))
+    return template, rules
+
+
+def _parameters(fields):
+    found = []
+    for field in fields:
+        for value in field.target + (field.const,):
+            if isinstance(value, Parameters) and value not in found:
+                found.append(value)
+    return found
+
+
+class Mapping:
+    """
+    A mapping spec, resolved on first use and kept for the container
+    lifetime.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._resolved = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        """
+        Return the `(template, rules)` of the mapping, with every referenced
+        parameter resolved by one batched SSM lookup.
+        """
+        with self._lock:
+            if self._resolved is None:
+                params = _parameters(self.fields)
+                values = Parameters.preload(*params) if params else {}
+
+                def resolve(value):
+                    return values[value] if isinstance(value, Parameters) else value
+
+                entries = []
+                for field in self.fields:
+                    const = resolve(field.const)
+                    if const is not MISSING and field.transform:
+                        const = field.transform(const)
+                    target = tuple(str(resolve(part)) for part in field.target)
+                    entries.append((field, target, const))
+                self._resolved = _build(entries, [target for _, target, _ in entries])
+            return self._resolved
+
+    def __call__(self, data):
+        template, rules = self._resolved or self.resolve()
+        out = template.copy()
+        for apply in rules:
+            apply(data, out)
+        return out
@@ -0,0 +1,282 @@
+"""
+Outbound call instrumentation.
+
+Every call to SSM, S3, Jira and ServiceNow is recorded with its latency,
+status and byte counts. At the end of an invocation (`instrument_handler`)
+the calls are flushed as CloudWatch Embedded Metric Format documents, one per
+dependency and operation, followed by a summary line with the time spent
+per dependency.
+
+HTTP clients mount `clients.adapters.InstrumentedAdapter`, boto3 clients
+are wrapped in `InstrumentedClient`, anything else can use the `timed`
+context manager. Events which are not calls (e.g. cache hits) are counted
+with `increment` and flushed alongside.
+"""
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Read here rather than in `settings`, which imports `aws.ssm` (and so this
+# module) first
+METRICS_ENABLED = os.environ.get('MetricsEnabled', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('MetricsNamespace', 'JiraToSnow')
+
+# CloudWatch accepts at most 100 values per metric in one EMF document
+MAX_VALUES = 100
+
+# boto3 client methods which do not call AWS
+LOCAL_METHODS = {
+    'can_paginate',
+    'generate_presigned_post',
+    'generate_presigned_url',
+    'get_paginator',
+    'get_waiter',
+}
+
+_calls = []
+_counters = {}
+_calls_lock = threading.Lock()
+
+
+class Call:
+    """
+    One outbound call; `status`, `bytes_sent` and `bytes_received` may be
+    filled in by the caller of `timed`.
+    """
+    __slots__ = ('dependency', 'operation', 'started', 'duration', 'status',
+                 'bytes_sent', 'bytes_received')
+
+    def __init__(self, dependency, operation):
+        self.dependency = dependency
+        self.operation = operation
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.status = 'ok'
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def failed(self):
+        return self.status == 'error' or (isinstance(self.status, int) and self.status >= 400)
+
+
+def record(call):
+    call.duration = (time.perf_counter() - call.started) * 1000
+    with _calls_lock:
+        _calls.append(call)
+
+
+@contextmanager
+def timed(dependency, operation):
+    call = Call(dependency, operation)
+    try:
+        yield call
+    except Exception:
+        call.status = 'error'
+        raise
+    finally:
+        record(call)
+
+
+def increment(dependency, name, value=1):
+    """
+    Add `value` to the counter `name` of `dependency` for this invocation.
+    """
+    with _calls_lock:
+        _counters[(dependency, name)] = _counters.get((dependency, name), 0) + value
+
+
+def operation_name(method, url):
+    """
+    `METHOD /path` with IDs, keys and file names replaced by `{id}`, so that
+    the operation has a bounded number of values.
+    """
+    segments = [
+        '{id}' if re.search(r'[\d.]', segment) else segment
+        for segment in urlparse(url).path.split('/')
+    ]
+    return f"{method} {'/'.join(segments)}"
+
+
+def _body_size(body):
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+class InstrumentedClient:
+    """
+    Proxy of a boto3 client timing every API method call.
+    """
+
+    def __init__(self, client, dependency):
+        self._client = client
+        self._dependency = dependency
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name in LOCAL_METHODS or name.startswith('_'):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            with timed(self._dependency, name) as current:
+                if 'Body' in kwargs:
+                    current.bytes_sent = _body_size(kwargs['Body'])
+                resp = attr(*args, **kwargs)
+                if isinstance(resp, dict):
+                    current.status = resp.get('ResponseMetadata', {}).get('HTTPStatusCode', 'ok')
+                    current.bytes_received = resp.get('ContentLength', 0)
+                return resp
+
+        return call
+
+
+def reset():
+    """
+    Clear the calls and counters recorded so far; returns the calls.
+    """
+    calls, _ = take()
+    return calls
+
+
+def take():
+    """
+    Return and clear the calls and the `{(dependency, name): value}`
+    counters recorded so far.
+    """
+    with _calls_lock:
+        calls = list(_calls)
+        counters = dict(_counters)
+        del _calls[:]
+        _counters.clear()
+    return calls, counters
+
+
+def emf_documents(function_name, calls, timestamp=None):
+    """
+    Build the EMF documents for `calls`, one per dependency and operation.
+    """
+    timestamp = int((timestamp or time.time()) * 1000)
+    groups = {}
+    for call in calls:
+        groups.setdefault((call.dependency, call.operation), []).append(call)
+    documents = []
+    for (dependency, operation), group in groups.items():
+        for i in range(0, len(group), MAX_VALUES):
+            chunk = group[i:i + MAX_VALUES]
+            documents.append({
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [['Function', 'Dependency', 'Operation']],
+                        'Metrics': [
+                            {'Name': 'Latency', 'Unit': 'Milliseconds'},
+                            {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'Errors', 'Unit': 'Count'},
+                            {'Name': 'BytesSent', 'Unit': 'Bytes'},
+                            {'Name': 'BytesReceived', 'Unit': 'Bytes'},
+                        ],
+                    }],
+                },
+                'Function': function_name,
+                'Dependency': dependency,
+                'Operation': operation,
+                'Latency': [round(call.duration, 3) for call in chunk],
+                'Calls': len(chunk),
+                'Errors': sum(1 for call in chunk if call.failed),
+                'BytesSent': sum(call.bytes_sent for call in chunk),
+                'BytesReceived': sum(call.bytes_received for call in chunk),
+                'Statuses': sorted({str(call.status) for call in chunk}),
+            })
+    return documents
+
+
+def counter_documents(function_name, counters, timestamp=None):
+    """
+    Build the EMF documents for `counters`, one per dependency.
+    """
+    timestamp = int((timestamp or time.time()) * 1000)
+    groups = {}
+    for (dependency, name), value in sorted(counters.items()):
+        groups.setdefault(dependency, {})[name] = value
+    documents = []
+    for dependency, values in groups.items():
+        document = {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function', 'Dependency']],
+                    'Metrics': [{'Name': name, 'Unit': 'Count'} for name in values],
+                }],
+            },
+            'Function': function_name,
+            'Dependency': dependency,
+        }
+        document.update(values)
+        documents.append(document)
+    return documents
+
+
+def summary(function_name, calls, duration, counters=None):
+    """
+    Per-invocation totals: calls, milliseconds and counters per dependency.
+    """
+    dependencies = {}
+    for call in calls:
+        total = dependencies.setdefault(call.dependency, {'calls': 0, 'ms': 0.0, 'errors': 0})
+        total['calls'] += 1
+        total['ms'] = round(total['ms'] + call.duration, 3)
+        total['errors'] += call.failed
+    for (dependency, name), value in sorted((counters or {}).items()):
+        total = dependencies.setdefault(dependency, {'calls': 0, 'ms': 0.0, 'errors': 0})
+        total[name] = value
+    return {
+        'summary': 'outbound_calls',
+        'function': function_name,
+        'duration_ms': round(duration, 3),
+        'dependencies': dependencies,
+    }
+
+
+def flush(function_name, duration, stream=None):
+    """
+    Write the EMF documents and the summary line of the calls and counters
+    recorded since the last flush.
+    """
+    calls, counters = take()
+    if not METRICS_ENABLED:
+        return
+    stream = stream or sys.stdout
+    documents = emf_documents(function_name, calls) + counter_documents(function_name, counters)
+    lines = [json.dumps(document) for document in documents]
+    lines.append(json.dumps(summary(function_name, calls, duration, counters)))
+    stream.write('\n'.join(lines) + '\n')
+    stream.flush()
+
+
+def instrument_handler(handler):
+    """
+    Decorate a Lambda handler to flush the metrics of every invocation.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        function_name = getattr(
+            context, 'function_name', None) or f'{handler.__module__}.{handler.__name__}'
+        reset()
+        started = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            flush(function_name, (time.perf_counter() - started) * 1000)
+
+    return wrapper
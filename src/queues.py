@@ -0,0 +1,109 @@
+"""
+Pluggable message queues for the asynchronous processing mode.
+
+`get_queue()` returns the backend selected by `QueueBackend` (`sqs`, `sqlite`
+or `memory`, see `backends`). Messages are JSON-serializable dicts; `receive` returns `(receipt, message)`
+pairs and a message is only gone once its receipt is passed to `delete`.
+"""
+import collections
+import itertools
+import json
+import sqlite3
+import threading
+
+import boto3
+from backends import Backend
+from settings import QUEUE_BACKEND, QUEUE_PATH, QUEUE_URL
+
+# SQS returns at most 10 messages per receive
+MAX_RECEIVE = 10
+
+
+class MemoryQueue:
+    def __init__(self):
+        self.messages = collections.OrderedDict()
+        self.in_flight = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.messages[next(self.ids)] = json.dumps(message)
+
+    def receive(self, max_messages=MAX_RECEIVE):
+        with self.lock:
+            received = []
+            while self.messages and len(received) < max_messages:
+                receipt, body = self.messages.popitem(last=False)
+                self.in_flight[receipt] = body
+                received.append((receipt, json.loads(body)))
+            return received
+
+    def delete(self, receipt):
+        with self.lock:
+            self.in_flight.pop(receipt, None)
+
+
+class SqliteQueue:
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "body TEXT NOT NULL, "
+                "received INTEGER NOT NULL DEFAULT 0)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def send(self, message):
+        with self.lock, self.connect() as conn:
+            conn.execute("INSERT INTO messages (body) VALUES (?)", (json.dumps(message),))
+
+    def receive(self, max_messages=MAX_RECEIVE):
+        with self.lock, self.connect() as conn:
+            rows = conn.execute(
+                "SELECT id, body FROM messages WHERE received = 0 ORDER BY id LIMIT ?",
+                (max_messages,)).fetchall()
+            conn.executemany(
+                "UPDATE messages SET received = 1 WHERE id = ?", [(row[0],) for row in rows])
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def delete(self, receipt):
+        with self.lock, self.connect() as conn:
+            conn.execute("DELETE FROM messages WHERE id = ?", (receipt,))
+
+
+class SqsQueue:
+    def __init__(self, queue_url=QUEUE_URL):
+        self.queue_url = queue_url
+        self.client = boto3.client('sqs')
+
+    def send(self, message):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+
+    def receive(self, max_messages=MAX_RECEIVE):
+        resp = self.client.receive_message(
+            QueueUrl=self.queue_url, MaxNumberOfMessages=min(max_messages, MAX_RECEIVE))
+        return [
+            (message['ReceiptHandle'], json.loads(message['Body']))
+            for message in resp.get('Messages', [])
+        ]
+
+    def delete(self, receipt):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+
+BACKENDS = {
+    "memory": MemoryQueue,
+    "sqlite": SqliteQueue,
+    "sqs": SqsQueue,
+}
+
+_queue = Backend(BACKENDS, QUEUE_BACKEND)
+
+
+def get_queue():
+    return _queue.get()
@@ -1,12 +1,12 @@
 import json
+import math
 import os
-import boto3
-from log_cfg import logger
+from log_cfg import Json, bind_invocation, logger
+from metrics import instrument_handler
+from aws import s3
 from aws.ssm import get_ssm_value
-from settings import Parameters
-from botocore.client import Config
-
-s3 = boto3.client('s3',config=Config(signature_version='s3v4'))
+from settings import (PRESIGN_BATCH_MAX_FILES, PRESIGN_MAX_PARTS, PRESIGN_MIN_PART_SIZE,
+                      PRESIGN_PART_SIZE, Parameters)
 
 S3_BUCKET = os.environ['S3SnowBucket']
 
@@ -32,7 +32,7 @@ def validate_event(event):
     status = 200
 
     queries = event.get("queryStringParameters", {})
-    logger.debug("Query Parameters: %s", json.dumps(queries))
+    logger.debug("Query Parameters: %s", Json(queries))
     httpMethod = event.get("httpMethod")
     if queries is None or 'issue_key' not in queries or 'file_name' not in queries:
         status = 400
@@ -58,12 +58,12 @@ def generate_presigned_url(issue_key, file_name, ttl):
         "ok": not error,
     }
     try:
-        upload_url = s3.generate_presigned_post(
+        upload_url = s3.get_client().generate_presigned_post(
             Bucket=S3_BUCKET,
             Key=f'{issue_key}/{file_name}',
             ExpiresIn=int(ttl)
         )
-        logger.debug('S3 presigned upload URL: {}'.format(upload_url))
+        logger.debug('S3 presigned upload URL: %s', Json(upload_url))
         resp["upload_url"] = upload_url
         resp["issue_key"] = issue_key
     except Exception as e:
@@ -76,21 +76,214 @@ def generate_presigned_url(issue_key, file_name, ttl):
         logger.error(error)
     return status, resp
 
+def validate_json_event(event, required):
+    """
+    Validate a POST route: its body must be a JSON object holding the
+    `required` keys. Returns `(status, resp, body)`.
+    """
+    body = None
+    error = None
+    status = 200
+
+    httpMethod = event.get("httpMethod")
+    if httpMethod != "POST":
+        status = 405
+        error = "Method not allowed: {}".format(httpMethod)
+    else:
+        try:
+            body = json.loads(event.get("body"))
+        except (json.decoder.JSONDecodeError, TypeError):
+            status = 400
+            error = "`body` is not valid JSON: {}".format(event.get("body"))
+        else:
+            missing = [key for key in required if not isinstance(body, dict) or not body.get(key)]
+            if missing:
+                status = 400
+                error = "{} must be defined in body".format(", ".join(f"`{key}`" for key in missing))
+    logger.debug("Body: %s", Json(body))
+
+    resp = {
+        "ok": not error,
+    }
+    if error:
+        resp["error"] = error
+        logger.error(error)
+    return status, resp, body
+
+
+def generate_presigned_urls(issue_key, file_names, ttl):
+    """
+    Sign one presigned POST per file name. Signing is local, so the batch
+    costs no more AWS calls than a single file.
+    """
+    if (not isinstance(file_names, list)
+            or not all(isinstance(file_name, str) and file_name for file_name in file_names)
+            or len(set(file_names)) != len(file_names)):
+        status, error = 400, "`file_names` must be a list of distinct, non-empty file names"
+    elif len(file_names) > PRESIGN_BATCH_MAX_FILES:
+        status, error = 400, f"Too many files: {len(file_names)}, the limit is {PRESIGN_BATCH_MAX_FILES}"
+    else:
+        status, error = 200, None
+    if error:
+        logger.error(error)
+        return status, {"ok": False, "error": error}
+
+    upload_urls = {}
+    for file_name in file_names:
+        status, resp = generate_presigned_url(issue_key, file_name, ttl)
+        if not resp["ok"]:
+            return status, resp
+        upload_urls[file_name] = resp["upload_url"]
+    return 200, {
+        "ok": True,
+        "issue_key": issue_key,
+        "upload_urls": upload_urls,
+    }
+
+
+def part_size_for(size):
+    """
+    Part size for an object of `size` bytes: `PRESIGN_PART_SIZE`, raised to
+    the next MiB when the object would need more than `PRESIGN_MAX_PARTS`.
+    """
+    part_size = max(PRESIGN_PART_SIZE, PRESIGN_MIN_PART_SIZE)
+    if size > part_size * PRESIGN_MAX_PARTS:
+        mib = 1024 * 1024
+        part_size = math.ceil(size / PRESIGN_MAX_PARTS / mib) * mib
+    return part_size
+
+
+def create_multipart_upload(issue_key, file_name, size, ttl):
+    """
+    Start a multipart upload and sign one `UploadPart` URL per part, so the
+    caller can upload the parts in parallel and then complete the upload.
+    """
+    if not isinstance(size, int) or size <= 0:
+        error = "`size` must be a positive number of bytes"
+        logger.error(error)
+        return 400, {"ok": False, "error": error}
+
+    key = f'{issue_key}/{file_name}'
+    part_size = part_size_for(size)
+    try:
+        client = s3.get_client()
+        upload_id = client.create_multipart_upload(Bucket=S3_BUCKET, Key=key)['UploadId']
+        parts = [
+            {
+                "part_number": part_number,
+                "url": client.generate_presigned_url(
+                    ClientMethod='upload_part',
+                    Params={
+                        'Bucket': S3_BUCKET,
+                        'Key': key,
+                        'UploadId': upload_id,
+                        'PartNumber': part_number,
+                    },
+                    ExpiresIn=int(ttl),
+                ),
+            }
+            for part_number in range(1, math.ceil(size / part_size) + 1)
+        ]
+    except Exception as e:
+        logger.error('Could not create S3 multipart upload: {}'.format(str(e)))
+        return 500, {"ok": False, "error": str(e)}
+
+    logger.debug('S3 multipart upload %s of %s: %s parts', upload_id, key, len(parts))
+    return 200, {
+        "ok": True,
+        "issue_key": issue_key,
+        "file_name": file_name,
+        "upload_id": upload_id,
+        "part_size": part_size,
+        "parts": parts,
+    }
+
+
+def complete_multipart_upload(issue_key, file_name, upload_id, parts):
+    """
+    Complete a multipart upload from the `{"part_number", "etag"}` list
+    returned by the part uploads. An upload that cannot be completed is left
+    to the bucket's lifecycle rule, so the caller may retry.
+    """
+    try:
+        parts = sorted(
+            ({'PartNumber': int(part['part_number']), 'ETag': str(part['etag'])} for part in parts),
+            key=lambda part: part['PartNumber'],
+        )
+    except (KeyError, TypeError, ValueError):
+        parts = None
+    if not parts:
+        error = "`parts` must be a list of `part_number` and `etag`"
+        logger.error(error)
+        return 400, {"ok": False, "error": error}
+
+    try:
+        s3.get_client().complete_multipart_upload(
+            Bucket=S3_BUCKET,
+            Key=f'{issue_key}/{file_name}',
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts},
+        )
+    except Exception as e:
+        logger.error('Could not complete S3 multipart upload: {}'.format(str(e)))
+        return 500, {"ok": False, "error": str(e)}
+    return 200, {
+        "ok": True,
+        "issue_key": issue_key,
+        "file_name": file_name,
+    }
+
+
+# (resource suffix, required body keys, handler) of the POST routes; the
+# longest suffix is listed first
+ROUTES = [
+    ("/multipart/complete", ("issue_key", "file_name", "upload_id", "parts"),
+     lambda body, ttl: complete_multipart_upload(
+         body["issue_key"], body["file_name"], body["upload_id"], body["parts"])),
+    ("/multipart", ("issue_key", "file_name", "size"),
+     lambda body, ttl: create_multipart_upload(
+         body["issue_key"], body["file_name"], body["size"], ttl)),
+    ("/batch", ("issue_key", "file_names"),
+     lambda body, ttl: generate_presigned_urls(body["issue_key"], body["file_names"], ttl)),
+]
+
+
+def route(event):
+    resource = event.get("resource") or ""
+    for suffix, required, func in ROUTES:
+        if resource.endswith(suffix):
+            return required, func
+    return None, None
+
+
+@instrument_handler
 def handler(event, context):
     """
     Generate S3 presigned url for uploading
     issue_key: issue id or key on JSD and must be on query string
     file_name: file name will put on S3 bucket and must be on query string
+
+    POST routes, with a JSON body:
+    /batch: presigned POSTs for every name of `file_names`
+    /multipart: start a multipart upload of `size` bytes and sign its parts
+    /multipart/complete: complete `upload_id` with the uploaded `parts`
     """
-    logger.debug("Event: %s", json.dumps(event))
+    bind_invocation(context)
+    logger.debug("Event: %s", Json(event))
     logger.info("HTTP request received, validating...")
-    status, resp, queries = validate_event(event)
+    required, func = route(event)
+    if func is None:
+        status, resp, queries = validate_event(event)
+    else:
+        status, resp, body = validate_json_event(event, required)
     if resp["ok"]:
         status, resp, s3_presigned_url_ttl = validate_environment()
-        if resp["ok"]:
+        if resp["ok"] and func is None:
             status, resp = generate_presigned_url(queries['issue_key'], queries['file_name'], s3_presigned_url_ttl)
+        elif resp["ok"]:
+            status, resp = func(body, s3_presigned_url_ttl)
 
     return {
         "statusCode": status,
         "body": json.dumps(resp)
-    }
\ No newline at end of file
+    }
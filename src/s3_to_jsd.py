@@ -1,62 +1,147 @@
-import json
-import boto3
 import os
 import sys
-from log_cfg import logger
+import idempotency
+from log_cfg import Json, bind_invocation, logger
+from metrics import instrument_handler
+from aws import s3
 from urllib.parse import unquote_plus
-from aws.ssm import get_ssm_value
-from settings import Parameters
-from clients import jsd
+from aws.ssm import get_ssm_values
+from settings import WORKER_POOL_SIZE, Parameters
+from clients import jsd, resilience
+from workers import map_bounded, start_deadline, transfer_estimate
 
 
-s3_client = boto3.client('s3')
-
-JIRA_SEVER = None
-JIRA_USER = None
-JIRA_API_KEY = None
-
 def validate_environment():
-    error = ''
-    global JIRA_SEVER, JIRA_USER, JIRA_API_KEY
-
-    err, JIRA_SEVER = get_ssm_value(key=Parameters.JIRA_HOST.value)
-    error += err
-    err, JIRA_USER = get_ssm_value(key=Parameters.JIRA_USER_ID.value)
-    error += err
-    err, JIRA_API_KEY = get_ssm_value(key=Parameters.JIRA_APP_PASSWORD.value)
-    error += err
-    logger.debug(f'JIRA_SEVER: {JIRA_SEVER} {JIRA_USER} {JIRA_API_KEY}')
+    error, _ = get_ssm_values([
+        Parameters.JIRA_HOST.value,
+        Parameters.JIRA_USER_ID.value,
+        Parameters.JIRA_APP_PASSWORD.value,
+    ])
     return error
 
+def parse_record(record):
+    """
+    Return `(bucket, key, issue_key, file_name, size)` of an S3 record.
+    """
+    bucket = record['s3']['bucket']['name']
+    key = unquote_plus(record['s3']['object']['key'])
+    logger.debug('bucket key: %s', key)
+    issue_key= key.split('/')[0]
+    logger.debug('issue_key: %s', issue_key)
+    tmpkey = key.replace(f'{issue_key}/', '')
+    return bucket, key, issue_key, os.path.basename(tmpkey), record['s3']['object']['size']
+
+
+def group_records(records):
+    """
+    Group records by bucket and issue key, keeping the order of arrival.
+    """
+    groups = {}
+    for record in records:
+        bucket, key, issue_key, file_name, size = parse_record(record)
+        groups.setdefault((bucket, issue_key), []).append((key, file_name, size))
+    return list(groups.items())
+
+
+def upload_objects(service_desk_id, bucket, objects):
+    """
+    Upload `objects` as temporary attachments with one multi-file request.
+    Objects are streamed from S3 one after the other, nothing is written to
+    /tmp.
+    """
+    return jsd.attach_temporary_files(service_desk_id, [
+        (file_name, s3.open_object(bucket, key, size), size)
+        for key, file_name, size in objects
+    ])
+
+
+def process_issue(group):
+    """
+    Attach every object of one issue with one multi-file temporary upload
+    and one `add_attachment` call. If Jira rejects the upload (a 4xx, or an
+    object which cannot be read), the files are sent one at a time so that
+    one bad object does not hold back the others. Other failures are raised
+    for a retry of the event: Jira may have received the files, and sending
+    them one by one would multiply the load during an outage.
+
+    Attached objects are deleted; returns the keys of the others, which are
+    left in S3.
+    """
+    (bucket, issue_key), objects = group
+    service_desk_id = jsd.get_request(issue_key)['serviceDeskId']
+    # Upload files as temporary attachments
+    try:
+        temp_attachment_ids = upload_objects(service_desk_id, bucket, objects)
+        sent = list(objects)
+    except Exception as ex:
+        if len(objects) == 1 or not resilience.is_rejected(ex):
+            raise
+        logger.warning('Upload of %s files to Jira failed, sending them one at a time: %s',
+                       len(objects), str(ex))
+        temp_attachment_ids = []
+        sent = []
+        for obj in objects:
+            try:
+                temp_attachment_ids += upload_objects(service_desk_id, bucket, [obj])
+                sent.append(obj)
+            except Exception as ex:
+                if not resilience.is_rejected(ex):
+                    raise
+                logger.error('Upload of %s to Jira failed: %s', obj[0], str(ex))
+    logger.debug('Temporary Attachment Ids: %s', temp_attachment_ids)
+    if temp_attachment_ids:
+        # Set attachments as public for customer
+        response = jsd.add_attachment(issue_key, temp_attachment_ids, public=True, comment=None)
+        logger.debug('Set attachments to be public for customer: %s', Json(response))
+        s3.delete_objects(bucket, [key for key, _, _ in sent])
+    unsent = [obj[0] for obj in objects if obj not in sent]
+    if unsent:
+        logger.error('Objects left in S3: %s', unsent)
+    return unsent
+
+
+@instrument_handler
 def handler(event, context):
-    
-    logger.debug("Event: %s", json.dumps(event))
+    """
+    Objects which are not attached, because their upload failed or was not
+    done before the deadline, are left in S3 and the handler fails, so that
+    Lambda delivers the event again; objects attached by this delivery are
+    skipped then.
+    """
+    bind_invocation(context)
+    deadline = start_deadline(context)
+    logger.debug("Event: %s", Json(event))
 
     error = validate_environment()
+    claims = {}
+    leftover = []
 
     if error:
         logger.error(error)
     else:
-        logger.debug(f'JIRA_SEVER: {JIRA_SEVER} {JIRA_USER} {JIRA_API_KEY}')
-        for record in event['Records']:
-            bucket = record['s3']['bucket']['name']
-            key = unquote_plus(record['s3']['object']['key'])
-            logger.debug('bucket key: {}'.format(key))
-            issue_key= key.split('/')[0]
-            logger.debug('issue_key: {}'.format(issue_key))
-            tmpkey = key.replace(f'{issue_key}/', '')
-            download_path = '/tmp/{}'.format(tmpkey)
-            s3_client.download_file(bucket, key, download_path)
-            try:
-                
-                cr = jsd.get_request(issue_key)
-                # Upload file as temporary attachment
-                temp_attachment_id = jsd.attach_temporary_file(cr['serviceDeskId'], download_path)
-                logger.debug('Temporary Attachment Id: {}'.format(temp_attachment_id))
-                # Set attachment as public for customer
-                response = jsd.add_attachment(issue_key,temp_attachment_id,public=True, comment=None)
-                logger.debug('Set attachment to be public for customer: {}'.format(response))
-            except Exception as ex:
-                logger.error('Upload attachments to Jira failed: {}'.format(str(ex)))
-            finally:
-                s3_client.delete_object(Bucket=bucket, Key=key)
\ No newline at end of file
+        try:
+            records, claims = s3.claim_records('s3_to_jsd', event['Records'])
+            groups = group_records(records)
+            # One Jira upload per issue, issues run in parallel
+            results = map_bounded(
+                process_issue,
+                groups,
+                max_workers=WORKER_POOL_SIZE,
+                deadline=deadline,
+                estimate=lambda group: transfer_estimate(sum(size for _, _, size in group[1])),
+            )
+            for ((bucket, _), objects), (unsent, ex) in zip(groups, results):
+                keys = [key for key, _, _ in objects]
+                if ex is not None:
+                    # Failed, not started, or still running at the deadline
+                    # and frozen with the invocation
+                    logger.error('Processing S3 record failed: {}'.format(str(ex)))
+                    unsent = keys
+                leftover += unsent
+                s3.settle_claims(claims, bucket, keys, unsent)
+        except Exception:
+            for claim_key in claims.values():
+                idempotency.release(claim_key)
+            raise
+    if leftover:
+        raise s3.ObjectsLeft(f'{len(leftover)} objects left for a retry: {leftover}')
@@ -1,126 +1,177 @@
-import json
-import boto3
 import os
 import sys
-import requests
-import calendar
-import time
-import base64
-from log_cfg import logger
-from requests.auth import HTTPBasicAuth
+import idempotency
+from log_cfg import Json, bind_invocation, logger
+from metrics import instrument_handler
+from aws import s3
 from urllib.parse import unquote_plus
-from aws.ssm import get_ssm_value, put_ssm_value
-from settings import Parameters
+from aws.ssm import get_ssm_values
+from clients import resilience, snow
+from settings import SNOW_MAX_PAYLOAD_SIZE, WORKER_POOL_SIZE, Parameters
+from workers import map_bounded, start_deadline, transfer_estimate
 
-s3_client = boto3.client('s3')
 
 # Service now configuration
-SNOW_AUTH_ENDPOINT = None
 SNOW_ATTACHMENT_ENDPOINT = None
-SNOW_X_IBM_CLIENT_ID = None
-SNOW_AUTH_USER_NAME = None
-SNOW_AUTH_PASSWORD = None
 
+# Upper bound on how much of a SNOW response is written to the log
+MAX_LOGGED_RESPONSE = 1000
 
-SSM_API_TOKEN_KEY=Parameters.SNOW_API_TOKEN_SSM_1.value
 
 def validate_environment():
-    error = ''
-    snow_endpoint = None
-    global SNOW_X_IBM_CLIENT_ID, SNOW_AUTH_USER_NAME, SNOW_AUTH_PASSWORD, SNOW_AUTH_ENDPOINT, SNOW_ATTACHMENT_ENDPOINT
-    err, snow_endpoint = get_ssm_value(key=Parameters.SNOW_HOST.value)
-    error += err
-    err, SNOW_X_IBM_CLIENT_ID = get_ssm_value(key=Parameters.SNOW_CLIENT_ID.value)
-    error += err
-    err, SNOW_AUTH_USER_NAME = get_ssm_value(key=Parameters.SNOW_AUTH_USER_NAME.value)
-    error += err
-    err, SNOW_AUTH_PASSWORD = get_ssm_value(key=Parameters.SNOW_AUTH_PASSWORD.value)
-    error += err
-    SNOW_AUTH_ENDPOINT = f'{snow_endpoint}/authorization/token'
+    global SNOW_ATTACHMENT_ENDPOINT
+    error, (snow_endpoint, _, _, _) = get_ssm_values([
+        Parameters.SNOW_HOST.value,
+        Parameters.SNOW_CLIENT_ID.value,
+        Parameters.SNOW_AUTH_USER_NAME.value,
+        Parameters.SNOW_AUTH_PASSWORD.value,
+    ])
     SNOW_ATTACHMENT_ENDPOINT = f'{snow_endpoint}/itsm-incident/process/incidents'
     return error
 
-def get_api_token():
-    parameter = None
-    error, parameter = get_ssm_value(key=SSM_API_TOKEN_KEY, with_decryption=True)    
-    if error:
-        data = request_access_token()
-        return data['access_token']
-    else:
-        data = json.loads(parameter)
-        if check_if_token_is_valid(data['expires']) == False:
-            data = request_access_token()
-        return data['access_token']
-
-
-def request_access_token():
-    headers = {
-        "X-IBM-Client-ID" : SNOW_X_IBM_CLIENT_ID
-    }
-    auth = HTTPBasicAuth(SNOW_AUTH_USER_NAME, SNOW_AUTH_PASSWORD)
-    res = requests.request(method='GET',url=SNOW_AUTH_ENDPOINT,headers=headers,auth=auth)
-    data = json.loads(res.text)
-    put_ssm_value(key=SSM_API_TOKEN_KEY,value=json.dumps(data),type='SecureString')
-    return data
-
-def check_if_token_is_valid(exp_time):
-    # Check if the token does not expire
-    current_ts = calendar.timegm(time.gmtime())
-    return int(exp_time) > current_ts
-
-def upload_file_to_snow(download_path, cutomer_ref, file_name):
-    logger.debug('Fetch snow api token')
-    api_token = get_api_token()
-    logger.debug(f'API TOKEN: {api_token}')
-    headers = {
-        "X-IBM-Client-ID" : SNOW_X_IBM_CLIENT_ID,
-        "Authorization" : f'Bearer {api_token}'
-    }
-    logger.debug(f'Starting uploading to snow')
-    with open(download_path, 'rb') as out:
-        encoded_string = base64.b64encode(out.read())
-        payload = json.dumps({
-                "callingSystem" : "FINEOS-SERVICE-DESK",
-                "attachments" : [
-                    {
-                        "attachment" : encoded_string.decode('utf-8'),
-                        "contentType" : "",
-                        "fileName" : file_name
-                    }
-                ]
-        })
-        logger.debug(payload)
-        res = requests.request(method='PUT',url=f'{SNOW_ATTACHMENT_ENDPOINT}/{cutomer_ref}',headers=headers,data=payload,timeout=25)
-        logger.debug(f'Upload to SNOW: {res.text}')
+def upload_files_to_snow(session, cutomer_ref, attachments):
+    """
+    Send `attachments` (`(file_name, fileobj, size)` tuples) in one PUT
+    """
+    body = snow.AttachmentsBody(attachments)
+    logger.debug('Starting uploading to snow: %s files (%s bytes encoded)', len(attachments), len(body))
+    res = session.put(f'{SNOW_ATTACHMENT_ENDPOINT}/{cutomer_ref}',data=body)
+    logger.debug('Upload to SNOW: %s', res.text[:MAX_LOGGED_RESPONSE])
+    snow.raise_not_ok_exception(res)
+
+
+def parse_record(record):
+    """
+    Return `(bucket, key, customer_ref_key, file_name, size)` of an S3 record.
+    """
+    bucket = record['s3']['bucket']['name']
+    key = unquote_plus(record['s3']['object']['key'])
+    logger.debug('bucket key: %s', key)
+    customer_ref_key = key.split('/')[0]
+    jsd_attachment_id = key.split('/')[1]
+    logger.debug('CustomerRefNo: %s', customer_ref_key)
+    tmpkey = key.replace(f'{customer_ref_key}/{jsd_attachment_id}/', '')
+    logger.debug('filename: %s', tmpkey)
+    return bucket, key, customer_ref_key, tmpkey, record['s3']['object']['size']
+
+
+def pack_records(records, max_payload_size=SNOW_MAX_PAYLOAD_SIZE):
+    """
+    Group records by bucket and customer reference and split every group
+    into batches whose encoded PUT body stays within `max_payload_size`.
+    A file larger than the limit on its own gets a batch of its own.
+
+    Returns `((bucket, customer_ref_key), [(key, file_name, size)])` pairs.
+    """
+    groups = {}
+    for record in records:
+        bucket, key, customer_ref_key, file_name, size = parse_record(record)
+        groups.setdefault((bucket, customer_ref_key), []).append((key, file_name, size))
+    batches = []
+    for group, objects in groups.items():
+        batch = []
+        for obj in objects:
+            candidate = batch + [obj]
+            encoded_size = len(snow.AttachmentsBody(
+                [(file_name, None, size) for _, file_name, size in candidate]))
+            if batch and encoded_size > max_payload_size:
+                batches.append((group, batch))
+                candidate = [obj]
+            batch = candidate
+        batches.append((group, batch))
+    return batches
 
 
+def upload_objects(session, bucket, customer_ref_key, objects):
+    # Objects are opened one after the other while the body is sent
+    upload_files_to_snow(session, customer_ref_key, [
+        (file_name, s3.open_object(bucket, key, size), size)
+        for key, file_name, size in objects
+    ])
+
+
+def process_batch(session, batch):
+    """
+    Send a batch in one PUT. If ServiceNow rejects it (a 4xx, or an object
+    which cannot be read), the files are sent one at a time so that one bad
+    object does not hold back the others. Other failures are raised for a
+    retry of the event: ServiceNow may have stored the batch, and sending
+    the files one by one would multiply the load during an outage.
+
+    Sent objects are deleted; returns the keys of the others, which are
+    left in S3.
+    """
+    (bucket, customer_ref_key), objects = batch
+    try:
+        upload_objects(session, bucket, customer_ref_key, objects)
+        sent = list(objects)
+    except Exception as ex:
+        if len(objects) == 1 or not resilience.is_rejected(ex):
+            raise
+        logger.error(f'Failed:  {str(ex)}')
+        sent = []
+        for obj in objects:
+            try:
+                upload_objects(session, bucket, customer_ref_key, [obj])
+                sent.append(obj)
+            except Exception as ex:
+                if not resilience.is_rejected(ex):
+                    raise
+                logger.error(f'Failed:  {obj[0]}: {str(ex)}')
+    logger.debug('Deleting s3 objects:  %s', [key for key, _, _ in sent])
+    if sent:
+        s3.delete_objects(bucket, [key for key, _, _ in sent])
+    unsent = [obj[0] for obj in objects if obj not in sent]
+    if unsent:
+        logger.error('Objects left in S3: %s', unsent)
+    return unsent
+
+
+@instrument_handler
 def handler(event, context):
-    
-    logger.debug("Event: %s", json.dumps(event))
+    """
+    Objects which are not sent, because their PUT failed or was not done
+    before the deadline, are left in S3 and the handler fails, so that
+    Lambda delivers the event again; objects sent by this delivery are
+    skipped then.
+    """
+    bind_invocation(context)
+    deadline = start_deadline(context)
+    logger.debug("Event: %s", Json(event))
     error = validate_environment()
+    claims = {}
+    leftover = []
     
     if error:
         logger.error(error)
     else:
         try:
-            for record in event['Records']:
-                bucket = record['s3']['bucket']['name']
-                key = unquote_plus(record['s3']['object']['key'])
-                logger.debug(f'bucket key: {key}')
-                customer_ref_key = key.split('/')[0]
-                jsd_attachment_id = key.split('/')[1]
-                logger.debug(f'CustomerRefNo: {customer_ref_key}')
-                tmpkey = key.replace(f'{customer_ref_key}/{jsd_attachment_id}/', '')
-                logger.debug(f'filename: {tmpkey}')
-                download_path = '/tmp/{}'.format(tmpkey)
-                s3_client.download_file(bucket, key, download_path)
-                try:
-                    upload_file_to_snow(download_path, customer_ref_key, tmpkey)
-                except Exception as ex:
-                    logger.error(f'Failed:  {str(ex)}')
-                finally:
-                    logger.debug(f'Deleting s3 object:  {key}')
-                    s3_client.delete_object(Bucket=bucket, Key=key)
+            records, claims = s3.claim_records('s3_to_snow', event['Records'])
+            batches = pack_records(records)
+            # The token and headers are resolved once for all the PUTs
+            session = snow.get_session()
+            # Each batch streams S3 -> SNOW on its own worker, so downloads
+            # of some batches overlap with uploads of others
+            results = map_bounded(
+                lambda batch: process_batch(session, batch),
+                batches,
+                max_workers=WORKER_POOL_SIZE,
+                deadline=deadline,
+                estimate=lambda batch: transfer_estimate(sum(size for _, _, size in batch[1])),
+            )
+            for ((bucket, _), objects), (unsent, exc) in zip(batches, results):
+                keys = [key for key, _, _ in objects]
+                if exc is not None:
+                    # Failed, not started, or still running at the deadline
+                    # and frozen with the invocation
+                    logger.error(f'Failed:  {str(exc)}')
+                    unsent = keys
+                leftover += unsent
+                s3.settle_claims(claims, bucket, keys, unsent)
         except Exception as exc:
             logger.error(f'Failed:  {str(exc)}')
-
+            for claim_key in claims.values():
+                idempotency.release(claim_key)
+            raise
+    if leftover:
+        raise s3.ObjectsLeft(f'{len(leftover)} objects left for a retry: {leftover}')
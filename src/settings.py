@@ -2,8 +2,83 @@ import os
 import logging
 from enum import Enum
 
+from aws import ssm
+
 STAGE = os.environ['Stage']
 
+# Maximum number of pooled keep-alive connections per host
+HTTP_POOL_SIZE = int(os.environ.get('HttpPoolSize', '10'))
+
+# Connect and read timeouts (seconds) for outbound HTTP calls
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HttpConnectTimeout', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HttpReadTimeout', '25'))
+
+# Cache of Jira request lookups: seconds an entry is used (0 disables the
+# cache) and entries kept, least recently used first out
+JIRA_CACHE_TTL = float(os.environ.get('JiraCacheTtl', '5'))
+JIRA_CACHE_SIZE = int(os.environ.get('JiraCacheSize', '256'))
+
+# Per backend (Jira, ServiceNow) circuit breaker: consecutive failures
+# opening it, seconds before probing again and concurrent probes; bulkhead:
+# calls in flight and seconds a call waits for a slot
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CircuitFailureThreshold', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CircuitResetTimeout', '30'))
+CIRCUIT_HALF_OPEN_CALLS = int(os.environ.get('CircuitHalfOpenCalls', '1'))
+BULKHEAD_MAX_CALLS = int(os.environ.get('BulkheadMaxCalls', '8'))
+BULKHEAD_WAIT = float(os.environ.get('BulkheadWait', '5'))
+
+# Bounded worker pools: threads per pool, concurrent calls per remote host
+# and the overall time budget (seconds) for a fan-out
+WORKER_POOL_SIZE = int(os.environ.get('WorkerPoolSize', '8'))
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get('MaxConnectionsPerHost', '4'))
+ATTACHMENT_DEADLINE = float(os.environ.get('AttachmentDeadline', '25'))
+
+# Deadline of an invocation: seconds kept in reserve at the end (flushing
+# metrics, handing leftovers over) and the expected duration of a transfer,
+# setup time plus size at the expected rate (bytes per second). A transfer
+# is only started while the time left covers it
+DEADLINE_RESERVE = float(os.environ.get('DeadlineReserve', '2'))
+TRANSFER_SETUP_TIME = float(os.environ.get('TransferSetupTime', '2'))
+TRANSFER_RATE = int(os.environ.get('TransferRate', str(5 * 1024 * 1024)))
+
+# Largest encoded attachments PUT sent to ServiceNow (bytes); attachments of
+# the same incident are packed into PUTs up to this size
+SNOW_MAX_PAYLOAD_SIZE = int(os.environ.get('SnowMaxPayloadSize', str(10 * 1024 * 1024)))
+
+# Maximum number of incidents accepted by a bulk request
+BULK_MAX_ITEMS = int(os.environ.get('BulkMaxItems', '100'))
+
+# Presigned uploads: file names per batch request, and the part size (bytes)
+# of presigned multipart uploads, raised for objects needing more than the
+# 10000 parts S3 allows; parts other than the last must be at least 5 MiB
+PRESIGN_BATCH_MAX_FILES = int(os.environ.get('PresignBatchMaxFiles', '100'))
+PRESIGN_PART_SIZE = int(os.environ.get('PresignPartSize', str(64 * 1024 * 1024)))
+PRESIGN_MIN_PART_SIZE = 5 * 1024 * 1024
+PRESIGN_MAX_PARTS = 10000
+
+# Asynchronous mode: handlers enqueue requests (202) and a worker drains them
+ASYNC_MODE = os.environ.get('AsyncMode', 'false').lower() == 'true'
+QUEUE_BACKEND = os.environ.get('QueueBackend', 'sqs')
+QUEUE_URL = os.environ.get('QueueUrl')
+QUEUE_PATH = os.environ.get('QueuePath', '/tmp/queue.sqlite3')
+QUEUE_BATCH_SIZE = int(os.environ.get('QueueBatchSize', '10'))
+
+# Duplicate webhook deliveries within the window (seconds) are dropped;
+# 0 disables the check
+IDEMPOTENCY_WINDOW = int(os.environ.get('IdempotencyWindow', '300'))
+IDEMPOTENCY_BACKEND = os.environ.get('IdempotencyBackend', 'dynamodb')
+IDEMPOTENCY_TABLE = os.environ.get('IdempotencyTable')
+IDEMPOTENCY_PATH = os.environ.get('IdempotencyPath', '/tmp/idempotency.sqlite3')
+
+# Index of the SNOW incident <-> Jira issue links
+LINK_BACKEND = os.environ.get('LinkBackend', 'dynamodb')
+LINK_TABLE = os.environ.get('LinkTable')
+LINK_PATH = os.environ.get('LinkPath', '/tmp/links.sqlite3')
+
+# S3 multipart transfer settings (part size in bytes, parallel parts)
+S3_MULTIPART_CHUNK_SIZE = int(os.environ.get('S3MultipartChunkSize', str(8 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.environ.get('S3MaxConcurrency', '4'))
+
 
 def get_log_level():
     log_level = os.environ['LogLevel']
@@ -32,7 +107,22 @@ class Parameters(Enum):
     SNOW_AUTH_PASSWORD = f"/{STAGE}/SnowAuthPassword"
     SNOW_AUTH_URL = f"/{STAGE}/SnowAuthUrl"
     SNOW_API_TOKEN_SSM_2 = f"/{STAGE}/SNOW_API_TOKEN_KEY_2"
-    SNOW_API_TOKEN_SSM_1 = f"/{STAGE}/SNOW_API_TOKEN_KEY_1"
 
     # S3 parameters
     S3_PRESIGNED_URL_TTL = f"/{STAGE}/S3PresignUrlTtl"
+
+    def get(self):
+        """
+        Return the value of the parameter from the process-wide SSM cache.
+        """
+        return ssm.get_parameter_value(self.value)
+
+    @classmethod
+    def preload(cls, *params):
+        """
+        Fetch `params` in batched `GetParameters` calls and return them as a
+        `{Parameters: value}` dict. Each function's IAM policy only grants its
+        own parameters, so callers list what they need explicitly.
+        """
+        values = ssm.get_parameters([param.value for param in params])
+        return {param: values.get(param.value) for param in params}
@@ -1,16 +1,15 @@
 import copy
 import json
-import logging
 import os
 
-import boto3
-
-from clients.jsd import create_comment, create_request, get_request
-from settings import Parameters, get_log_level
-
-
-logger = logging.getLogger()
-logger.setLevel(get_log_level())
+from clients.jsd import create_comment, create_request, get_api_url, get_request
+from idempotency import request_key, run_once
+from links import issue_for, link
+from log_cfg import Json, bind_invocation, logger
+from metrics import instrument_handler
+from mapping import PRESENT, Field, Mapping
+from settings import BULK_MAX_ITEMS, Parameters
+from workers import host_slot, map_bounded
 
 
 def get_jirarequest(incident_id):
@@ -29,12 +28,6 @@ def get_jirarequest(incident_id):
     return request
 
 
-def get_param_value(name):
-    client = boto3.client("ssm")
-    parameter = client.get_parameter(Name=name, WithDecryption=True)
-    return parameter["Parameter"]["Value"]
-
-
 def validate_snow_incident_number(value):
     error = None
     if not value:
@@ -119,7 +112,10 @@ def validate_body(body, extra_fields=None, all_fields=True):
         for field in fields_to_validate:
             if error:
                 break
-            error = all_allowed_fields[field](body.get(field))
+            if field not in all_allowed_fields:
+                error = "Unknown field: `{}`".format(field)
+            else:
+                error = all_allowed_fields[field](body.get(field))
     resp = {
         "ok": not error,
     }
@@ -129,160 +125,253 @@ def validate_body(body, extra_fields=None, all_fields=True):
     return 400 if error else 200, resp
 
 
-def post_mapping(fields):
-    custom_field_id = get_param_value(Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID.value)
+def severity(priority):
+    return {"name": "Severity {}".format(priority)}
 
-    actual_result_field_id = get_param_value(Parameters.JIRA_ACTUAL_RESULT_FIELD_ID.value)
 
-    expected_result_field_id = get_param_value(Parameters.JIRA_EXPECTED_RESULT_FIELD_ID.value)
+def reported_description(fields):
+    return "{}\n\nReported by: {}".format(fields["description"], fields["reportedby"])
 
-    environment_field_id = get_param_value(Parameters.JIRA_ENVIRONMENT_FIELD_ID.value)
 
-    description = "{}\n\nReported by: {}".format(
-        fields["description"], fields["reportedby"]
-    )
-    return {
-        "serviceDeskId": int(
-            get_param_value(Parameters.JIRA_SERVICE_DESK_ID.value)),
-        "requestTypeId": int(
-            get_param_value(Parameters.JIRA_REQUEST_TYPE_ID.value)),
-        "requestFieldValues": {
-            custom_field_id: fields["snow_incident_number"],
-            actual_result_field_id: "N/A",
-            expected_result_field_id: "N/A",
-            environment_field_id: {
-                "value": "Production",
-            },
-            "priority": {
-                "name": "Severity {}".format(fields["priority"]),
-            },
-            "summary": fields["summary"],
-            "description": description,
-        }
-    }
+POST_MAPPING = Mapping([
+    Field("serviceDeskId", const=Parameters.JIRA_SERVICE_DESK_ID, transform=int),
+    Field("requestTypeId", const=Parameters.JIRA_REQUEST_TYPE_ID, transform=int),
+    Field(("requestFieldValues", Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID), "snow_incident_number"),
+    Field(("requestFieldValues", Parameters.JIRA_ACTUAL_RESULT_FIELD_ID), const="N/A"),
+    Field(("requestFieldValues", Parameters.JIRA_EXPECTED_RESULT_FIELD_ID), const="N/A"),
+    Field(("requestFieldValues", Parameters.JIRA_ENVIRONMENT_FIELD_ID), const={"value": "Production"}),
+    Field("requestFieldValues.priority", "priority", transform=severity),
+    Field("requestFieldValues.summary", "summary"),
+    Field("requestFieldValues.description", reported_description),
+])
+
+PUT_MAPPING = Mapping([
+    Field(Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID, "snow_incident_number", when=PRESENT),
+    Field("priority", "priority", when=PRESENT, transform=severity),
+    Field("summary", "summary", when=PRESENT),
+    Field("description", "description", when=PRESENT),
+    Field("status", "status", when=PRESENT),
+    Field("comment", "comment", when=PRESENT),
+    Field("reportedby", "reportedby", when=PRESENT),
+])
+
+
+def post_mapping(fields):
+    return POST_MAPPING(fields)
 
 
 def put_mapping(fields):
-    values = {}
-    if "snow_incident_number" in fields:
-        custom_field_id = get_param_value(Parameters.JIRA_CUSTOMER_REF_NO_FIELD_ID.value)
-
-        values[custom_field_id] = fields["snow_incident_number"]
-    if "priority" in fields:
-        values["priority"] = {
-            "name": "Severity {}".format(fields["priority"]),
-        }
-    if "summary" in fields:
-        values["summary"] = fields["summary"]
-    if "description" in fields:
-        values["description"] = fields["description"]
-    if "status" in fields:
-        values["status"] = fields["status"]
-    if "comment" in fields:
-        values["comment"] = fields["comment"]
-    if "reportedby" in fields:
-        values["reportedby"] = fields["reportedby"]
-    return values
+    return PUT_MAPPING(fields)
 
 
 def create_jsd_incident(body):
     # Creating a Jira Service Desk Incident
     logger.debug("Creating an incident in Jira Service Desk...")
     issue = create_request(body)
-    logger.debug("Response is... %s",issue)
+    logger.debug("Response is... %s", Json(issue))
     return issue["issueKey"]
 
 
-def create_request_comment(incident_id, field, value, reported_by=None):
+# Fields compared against the current Jira request, with how to read the
+# current and the new value
+DIFF_FIELDS = (
+    ("summary",
+     lambda request: request["requestFieldValues"].get("summary"),
+     lambda body: body["summary"]),
+    ("description",
+     lambda request: request["requestFieldValues"].get("description"),
+     lambda body: body["description"]),
+    ("priority",
+     lambda request: (request["requestFieldValues"].get("priority") or {}).get("name"),
+     lambda body: body["priority"]["name"]),
+    ("status",
+     lambda request: request["currentStatus"].get("status"),
+     lambda body: body["status"]),
+)
+
+
+def diff_request(request, body):
+    """
+    Return `(field, new_value)` for every field of `body` which differs from
+    the fetched Jira `request`.
+    """
+    changes = []
+    for field, current_value, new_value in DIFF_FIELDS:
+        if field in body:
+            value = new_value(body)
+            if current_value(request) != value:
+                changes.append((field, value))
+    return changes
+
+
+def format_update_comment(changes, comment=None, reported_by=None):
     reporter = f" ({reported_by})" if reported_by else ""
-    field = field.capitalize() if field else None
-    text = f" {field} updated to \"{value}\"" if field else value
-    comment = f"Metlife ServiceNow Incident Update{reporter}: {text}"
-    create_comment(incident_id, comment)
+    lines = [f"{field.capitalize()} updated to \"{value}\"" for field, value in changes]
+    if comment:
+        lines.append(f"New Comment Added\n{comment}")
+    text = "\n".join(lines)
+    return f"Metlife ServiceNow Incident Update{reporter}: {text}"
 
 
 def update_jsd_incident(incident_id, body):
     # Updating a Jira Service Desk Incident
-    logger.debug(f"Updating an incident in JSD: {incident_id}")
-
-    reported_by = body.get("reportedby")
-    request = get_jirarequest(incident_id)
-    if "summary" in body:
-        old_summary = request["requestFieldValues"]["summary"]
-        new_summary = body["summary"]
-        if old_summary != new_summary:
-            create_request_comment(
-                incident_id, "summary", new_summary, reported_by=reported_by)
-    if "description" in body:
-        old_description = request["requestFieldValues"]["description"]
-        new_description = body["description"]
-        if old_description != new_description:
-            create_request_comment(
-                incident_id,
-                "description",
-                new_description,
-                reported_by=reported_by
-            )
-    if "priority" in body:
-        old_priority = request["requestFieldValues"]["priority"]["name"]
-        new_priority = body["priority"]["name"]
-        if old_priority != new_priority:
-            create_request_comment(
-                incident_id, "priority", new_priority, reported_by=reported_by)
-    if "status" in body:
-        old_status = request["currentStatus"]["status"]
-        new_status = body["status"]
-        if old_status != new_status:
-            create_request_comment(
-                incident_id, "status", new_status, reported_by=reported_by)
-    if "comment" in body:
-        text = f"New Comment Added\n{body['comment']}"
-        create_request_comment(incident_id, None, text, reported_by=reported_by)
-
+    logger.debug("Updating an incident in JSD: %s", incident_id)
+
+    changes = []
+    if any(field in body for field, _, _ in DIFF_FIELDS):
+        request = get_jirarequest(incident_id)
+        changes = diff_request(request, body)
+    comment = body.get("comment")
+    if not changes and not comment:
+        logger.debug("Nothing changed, skipping the JSD update")
+        return
+    # All changes go into a single comment
+    create_comment(incident_id, format_update_comment(
+        changes, comment=comment, reported_by=body.get("reportedby")))
+
+
+PUT_EXTRA_FIELDS = {
+    "status": validate_status,
+    "comment": validate_comment,
+}
 
-def post_request_handler(body):
-    logger.debug("POST HTTP request received, validating...")
 
-    # Validation
-    status, resp = validate_body(body)
+def validate_request(method, body):
+    logger.debug("%s HTTP request received, validating...", method)
+    if method == "POST":
+        status, resp = validate_body(body)
+    else:
+        status, resp = validate_body(
+            body, extra_fields=PUT_EXTRA_FIELDS, all_fields=False)
     if status != 200:
         logger.debug("Body validation failed: %s", resp["error"])
-        return status, resp
     else:
         logger.debug("Body validation passed")
+    return status, resp
 
-    # Mapping
-    body = post_mapping(body)
 
-    # Creating a JSD incident
-    resp["vendorticketnumber"] = create_jsd_incident(body)
+def apply_post(body):
+    """
+    Map a validated POST body and create the JSD request, unless the
+    incident is already linked to one.
+    """
+    incident_number = body["snow_incident_number"]
+    issue_key = issue_for(incident_number)
+    if issue_key:
+        logger.info("SNOW incident %s is already linked to %s", incident_number, issue_key)
+    else:
+        issue_key = create_jsd_incident(post_mapping(body))
+        link(incident_number, issue_key)
+    return 200, {
+        "ok": True,
+        "vendorticketnumber": issue_key,
+    }
 
-    return status, resp
 
+def apply_put(incident_id, body):
+    """
+    Map a validated PUT body and update the JSD request.
+    """
+    update_jsd_incident(incident_id, put_mapping(body))
+    return 200, {"ok": True}
 
-def put_request_handler(incident_id, body):
-    logger.debug("PUT HTTP request received, validating...")
 
-    # Validation
-    extra_fields = {
-        "status": validate_status,
-        "comment": validate_comment,
-    }
-    status, resp = validate_body(
-        body, extra_fields=extra_fields, all_fields=False)
+def post_request_handler(body):
+    status, resp = validate_request("POST", body)
+    if status != 200:
+        return status, resp
+    return apply_post(body)
+
+
+def put_request_handler(incident_id, body):
+    status, resp = validate_request("PUT", body)
     if status != 200:
-        logger.debug("Body validation failed: %s", resp["error"])
         return status, resp
+    return apply_put(incident_id, body)
+
+
+def dispatch(method, incident_id, body):
+    if method == "POST":
+        return post_request_handler(body)
+    return put_request_handler(incident_id, body)
+
+
+def run_request(method, incident_id, body, func):
+    """
+    Run `func` once per delivery of the request; ServiceNow retries webhooks
+    and identical deliveries get the first response.
+    """
+    if method == "POST":
+        ticket = body.get("snow_incident_number") if isinstance(body, dict) else None
     else:
-        logger.debug("Body validation passed")
+        ticket = incident_id
+    return run_once(request_key(f"snow-{method}", ticket, body), func)
 
-    # Mapping
-    body = put_mapping(body)
 
-    # Updating
-    update_jsd_incident(incident_id, body)
+def validate_bulk(method, items):
+    """
+    Validate every incident of a bulk request in one pass.
 
-    return status, resp
+    Returns `(status, resp)` for the request as a whole, and the list of
+    `(incident_id, body, error)` per item; `error` is a `(status, resp)`
+    pair for invalid items.
+    """
+    error = None
+    if not isinstance(items, list) or not items:
+        error = "`body` must be a non-empty list of incidents"
+    elif len(items) > BULK_MAX_ITEMS:
+        error = f"Too many incidents: {len(items)}, the limit is {BULK_MAX_ITEMS}"
+    if error:
+        logger.error(error)
+        return 400, {"ok": False, "error": error}, []
+
+    checked = []
+    for item in items:
+        incident_id = None
+        if not isinstance(item, dict):
+            checked.append((None, item, (400, {"ok": False, "error": "Incident is not an object"})))
+            continue
+        if method == "PUT":
+            item = dict(item)
+            incident_id = item.pop("incidentId", None)
+            if not incident_id:
+                checked.append((None, item, (400, {"ok": False, "error": "`incidentId` is empty"})))
+                continue
+        status, resp = validate_request(method, item)
+        checked.append((incident_id, item, None if status == 200 else (status, resp)))
+    return 200, {"ok": True}, checked
+
+
+def bulk_handler(method, items):
+    """
+    Create (POST) or update (PUT) a list of incidents. Invalid or failing
+    incidents do not fail the others: the response lists a `(status, resp)`
+    per incident, in request order, and is a 207 unless all succeeded.
+    """
+    status, resp, checked = validate_bulk(method, items)
+    if status != 200:
+        return status, resp
+
+    def process(item):
+        incident_id, body, error = item
+        if error:
+            return error
+        if method == "POST":
+            func = lambda: apply_post(body)
+        else:
+            func = lambda: apply_put(incident_id, body)
+        with host_slot(get_api_url()):
+            return run_request(method, incident_id, body, func)
+
+    results = []
+    for (incident_id, _, _), (result, ex) in zip(checked, map_bounded(process, checked)):
+        if ex is not None:
+            logger.error("Bulk %s of incident %s failed: %s", method, incident_id, ex)
+            result = 500, {"ok": False, "error": str(ex)}
+        item_status, item_resp = result
+        results.append(dict(item_resp, status=item_status))
+    ok = all(result["status"] == 200 for result in results)
+    return 200 if ok else 207, {"ok": ok, "results": results}
 
 
 def validate_event(event):
@@ -290,7 +379,7 @@ def validate_event(event):
     error = None
 
     headers = event.get("headers", {})
-    logger.debug("Headers: %s", json.dumps(headers))
+    logger.debug("Headers: %s", Json(headers))
 
     content_type_name = "content-type"
     content_type_value = None
@@ -323,17 +412,21 @@ def validate_event(event):
     return status, resp, body
 
 
+@instrument_handler
 def handler(event, context):
-    logger.debug("Event: %s", json.dumps(event))
+    bind_invocation(context)
+    logger.debug("Event: %s", Json(event))
     logger.info("HTTP request received, validating...")
     status, resp, body = validate_event(event)
     if resp["ok"]:
         method = event.get("httpMethod")
-        if method == "POST":
-            status, resp = post_request_handler(body)
-        elif method == "PUT":
-            incident_id = event.get("pathParameters", {}).get("incidentId")
-            status, resp = put_request_handler(incident_id, body)
+        incident_id = (event.get("pathParameters") or {}).get("incidentId")
+        if (event.get("resource") or "").endswith("/bulk"):
+            status, resp = bulk_handler(method, body)
+        else:
+            status, resp = run_request(
+                method, incident_id, body,
+                lambda: dispatch(method, incident_id, body))
     return {
         "isBase64Encoded": False,
         "statusCode": status,
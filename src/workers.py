@@ -0,0 +1,153 @@
+"""
+Bounded thread pools shared by the handlers.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+from settings import (DEADLINE_RESERVE, MAX_CONNECTIONS_PER_HOST, TRANSFER_RATE,
+                      TRANSFER_SETUP_TIME, WORKER_POOL_SIZE)
+
+# Shortest timeout given to a call, however little time is left
+MIN_TIMEOUT = 0.1
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+# Deadline of the running invocation, see `start_deadline`
+_deadline = None
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class NotStarted(DeadlineExceeded):
+    """
+    The item was not started, so it can be retried as a whole.
+    """
+
+
+class Deadline:
+    """
+    Time left to an invocation, minus `reserve` seconds; unbounded when
+    `seconds` is `None`.
+    """
+
+    def __init__(self, seconds=None, reserve=DEADLINE_RESERVE):
+        self.expires = None if seconds is None else time.monotonic() + seconds - reserve
+
+    @classmethod
+    def from_context(cls, context):
+        get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+        return cls(get_remaining() / 1000 if get_remaining else None)
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def allows(self, seconds):
+        remaining = self.remaining()
+        return remaining is None or remaining >= seconds
+
+
+def start_deadline(context):
+    """
+    Set the deadline of the invocation from the Lambda context and return
+    it. Call at the top of a handler; outbound HTTP calls then get at most
+    the time left as timeout (`cap_timeout`).
+    """
+    global _deadline
+    _deadline = Deadline.from_context(context)
+    return _deadline
+
+
+def current_deadline():
+    return _deadline
+
+
+def cap_timeout(timeout):
+    """
+    Cap a `requests` timeout (seconds or a `(connect, read)` pair) to the
+    time left to the invocation.
+    """
+    remaining = _deadline.remaining() if _deadline is not None else None
+    if remaining is None:
+        return timeout
+    remaining = max(remaining, MIN_TIMEOUT)
+    if isinstance(timeout, tuple):
+        return tuple(remaining if part is None else min(part, remaining) for part in timeout)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def transfer_estimate(size):
+    """
+    Expected seconds to transfer `size` bytes.
+    """
+    return TRANSFER_SETUP_TIME + size / TRANSFER_RATE
+
+
+def host_slot(url):
+    """
+    Return the semaphore capping concurrent calls to the host of `url`.
+    Use it as a context manager around the outbound call.
+    """
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _host_slots[host]
+
+
+def map_bounded(func, items, max_workers=WORKER_POOL_SIZE, timeout=None, deadline=None,
+                estimate=None):
+    """
+    Call `func(item)` for every item on at most `max_workers` threads.
+
+    Returns a list of `(result, exception)` pairs in the order of `items`.
+    Items which have not finished `timeout` seconds after the start get a
+    `DeadlineExceeded` exception; those not started yet are cancelled and
+    get `NotStarted`. With a `deadline`, `timeout` is at most the time it
+    has left, and an item is only started while that time covers
+    `estimate(item)` seconds, or while no other item is running, so that an
+    item estimated to take longer than the whole budget still gets a try.
+    """
+    items = list(items)
+    if not items:
+        return []
+    if deadline is not None and deadline.remaining() is not None:
+        timeout = deadline.remaining() if timeout is None else min(timeout, deadline.remaining())
+    running = [0]
+    running_lock = threading.Lock()
+
+    def run(item):
+        with running_lock:
+            if deadline is not None and not deadline.allows(estimate(item) if estimate else 0):
+                if running[0] or deadline.remaining() <= 0:
+                    raise NotStarted('Not enough time left to start')
+            running[0] += 1
+        try:
+            return func(item)
+        finally:
+            with running_lock:
+                running[0] -= 1
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    try:
+        futures = [executor.submit(run, item) for item in items]
+        done, not_done = wait(futures, timeout=timeout)
+        cancelled = {future for future in not_done if future.cancel()}
+    finally:
+        executor.shutdown(wait=False)
+    results = []
+    for future in futures:
+        if future in cancelled:
+            results.append((None, NotStarted(f'Not started within {timeout}s')))
+        elif future not in done:
+            results.append((None, DeadlineExceeded(f'Not finished within {timeout}s')))
+        elif future.exception() is not None:
+            results.append((None, future.exception()))
+        else:
+            results.append((future.result(), None))
+    return results
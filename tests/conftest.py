@@ -0,0 +1,14 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+os.environ.setdefault("Stage", "test")
+os.environ.setdefault("LogLevel", "WARNING")
+os.environ.setdefault("S3SnowBucket", "snow-attachments-test")
+os.environ.setdefault("S3_JSD_BUCKET", "jsd-attachments-test")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("IdempotencyBackend", "memory")
+os.environ.setdefault("LinkBackend", "memory")
+os.environ.setdefault("QueueBackend", "memory")
@@ -0,0 +1,19 @@
+import pytest
+from log_cfg import REDACTED, scrub
+
+
+@pytest.mark.parametrize("key", [
+    "password", "auth", "auth_token", "Auth-Header", "Authorization", "X-Api-Key", "secret",
+])
+def test_secret_keys_are_redacted(key):
+    assert scrub({key: "value"}) == {key: REDACTED}
+
+
+@pytest.mark.parametrize("key", ["author", "authorAccountId", "updateAuthor"])
+def test_author_survives_redaction(key):
+    assert scrub({key: "value"}) == {key: "value"}
+
+
+def test_comment_author_is_kept():
+    event = {"comment": {"author": {"displayName": "Jane Doe"}, "body": "Done"}}
+    assert scrub(event) == event
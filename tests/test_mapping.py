@@ -0,0 +1,63 @@
+from mapping import PRESENT, TRUTHY, Field, Mapping
+
+TABLE = {"a": "A"}
+
+MAPPING = Mapping([
+    Field("const", const="c"),
+    Field("nested.const", const={"value": 1}),
+    Field("copied", const=[1]),
+    Field("default", "x.y", default="d"),
+    Field("optional", "x.y"),
+    Field("present", "p", when=PRESENT),
+    Field("truthy", "t", when=TRUTHY, transform=str.upper),
+    Field("guarded", const="g", when=TRUTHY, guard="x.flag"),
+    Field("translated", "x.code", default=None, when=TRUTHY, guard="x.flag",
+          translate=TABLE, translate_default="other"),
+    Field("passed", "x.code", translate=TABLE),
+    Field("nested.value", "x.y", when=PRESENT, transform=len),
+    Field("computed", lambda data: sorted(data)),
+])
+
+
+def test_empty_input():
+    assert MAPPING({}) == {
+        "const": "c",
+        "nested": {"const": {"value": 1}},
+        "copied": [1],
+        "default": "d",
+        "computed": [],
+    }
+
+
+def test_full_input():
+    data = {"x": {"y": "yy", "flag": True, "code": "a"}, "p": None, "t": "t"}
+    assert MAPPING(data) == {
+        "const": "c",
+        "nested": {"const": {"value": 1}, "value": 2},
+        "copied": [1],
+        "default": "yy",
+        "optional": "yy",
+        "present": None,
+        "truthy": "T",
+        "guarded": "g",
+        "translated": "A",
+        "passed": "A",
+        "computed": ["p", "t", "x"],
+    }
+
+
+def test_guard_and_translation_fallbacks():
+    out = MAPPING({"x": {"flag": 1, "code": "z"}, "t": ""})
+    assert out["translated"] == "other"
+    assert out["passed"] == "z"
+    assert "truthy" not in out
+    assert "present" not in out
+
+
+def test_constants_are_not_shared():
+    first = MAPPING({})
+    first["copied"].append(2)
+    first["nested"]["const"]["value"] = 2
+    second = MAPPING({})
+    assert second["copied"] == [1]
+    assert second["nested"]["const"] == {"value": 1}
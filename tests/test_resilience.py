@@ -0,0 +1,56 @@
+import http.server
+import io
+import threading
+
+import pytest
+import requests
+from clients import resilience
+from clients.adapters import InstrumentedAdapter
+from clients.jsd import MultipartBody
+from clients.snow import AttachmentsBody
+from settings import CIRCUIT_FAILURE_THRESHOLD
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+
+
+def session(dependency):
+    session = requests.Session()
+    session.mount("http://", InstrumentedAdapter(dependency))
+    return session
+
+
+def size_changed():
+    raise IOError("file.txt: size changed from 10 to 4 bytes")
+
+
+@pytest.mark.parametrize("body", [
+    lambda: MultipartBody([("file.txt", io.BytesIO(b"abcd"), 10)]),
+    lambda: MultipartBody([("file.txt", size_changed, 10)]),
+    lambda: AttachmentsBody([("file.txt", io.BytesIO(b"abcd"), 10)]),
+])
+def test_unreadable_body_keeps_circuit_closed(url, body):
+    dependency = f"test-{id(body)}"
+    client = session(dependency)
+    for _ in range(CIRCUIT_FAILURE_THRESHOLD + 1):
+        with pytest.raises(resilience.SourceError):
+            client.post(url, data=body())
+    breaker = resilience.get_breaker(dependency)
+    assert breaker.state == resilience.CLOSED
+    assert breaker.failures == 0
+    assert client.post(url, data=b"ok").status_code == 200
@@ -0,0 +1,137 @@
+import idempotency
+import pytest
+import requests
+import s3_to_jsd
+import s3_to_snow
+from aws import s3
+from clients import jsd, snow
+
+
+def s3_event(*keys):
+    return {"Records": [
+        {"s3": {
+            "bucket": {"name": "bucket"},
+            "object": {"key": key, "size": 10, "sequencer": str(index)},
+        }}
+        for index, key in enumerate(keys)
+    ]}
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} Error", response=response)
+
+
+@pytest.fixture
+def store(monkeypatch):
+    idempotency._store.reset()
+    deleted = []
+    monkeypatch.setattr(s3, "delete_objects", lambda bucket, keys: deleted.extend(keys))
+    monkeypatch.setattr(s3_to_jsd, "validate_environment", lambda: None)
+    monkeypatch.setattr(s3_to_snow, "validate_environment", lambda: None)
+    monkeypatch.setattr(jsd, "get_request", lambda issue_key: {"serviceDeskId": "1"})
+    monkeypatch.setattr(jsd, "add_attachment", lambda *args, **kwargs: {})
+    monkeypatch.setattr(snow, "get_session", lambda: None)
+    store = idempotency.get_store()
+    store.deleted = deleted
+    return store
+
+
+def completed(store):
+    return sorted(key for key, item in store.items.items() if item["response"])
+
+
+def test_s3_to_jsd_completes_attached_objects(store, monkeypatch):
+    monkeypatch.setattr(jsd, "attach_temporary_files", lambda desk, files: ["t"] * len(files))
+    s3_to_jsd.handler(s3_event("FSD-1/file-0", "FSD-1/file-1"), None)
+    assert store.deleted == ["FSD-1/file-0", "FSD-1/file-1"]
+    assert len(completed(store)) == 2
+
+
+def test_s3_to_jsd_retries_failed_upload(store, monkeypatch):
+    def unavailable(desk, files):
+        raise http_error(503)
+    monkeypatch.setattr(jsd, "attach_temporary_files", unavailable)
+    with pytest.raises(s3.ObjectsLeft):
+        s3_to_jsd.handler(s3_event("FSD-1/file-0", "FSD-1/file-1"), None)
+    assert store.deleted == []
+    assert store.items == {}
+
+
+def test_s3_to_snow_retries_failed_upload(store, monkeypatch):
+    def unavailable(session, customer_ref, attachments):
+        raise http_error(503)
+    monkeypatch.setattr(s3_to_snow, "upload_files_to_snow", unavailable)
+    with pytest.raises(s3.ObjectsLeft):
+        s3_to_snow.handler(s3_event("INC1/1/file-0", "INC1/2/file-1"), None)
+    assert store.deleted == []
+    assert store.items == {}
+
+
+def test_failed_claim_releases_earlier_claims(store, monkeypatch):
+    claim = store.claim
+
+    def throttled(key, expires):
+        if store.items:
+            raise requests.exceptions.ConnectionError("throttled")
+        return claim(key, expires)
+    monkeypatch.setattr(store, "claim", throttled)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        s3_to_jsd.handler(s3_event("FSD-1/file-0", "FSD-1/file-1"), None)
+    assert store.items == {}
+
+
+def test_s3_to_jsd_sends_files_one_by_one_when_rejected(store, monkeypatch):
+    calls = []
+
+    def attach(desk, files):
+        calls.append([file_name for file_name, _, _ in files])
+        if any(file_name == "bad" for file_name, _, _ in files):
+            raise jsd.ClientError("Bad request", http_error(400).response)
+        return ["t"] * len(files)
+    monkeypatch.setattr(jsd, "attach_temporary_files", attach)
+    with pytest.raises(s3.ObjectsLeft):
+        s3_to_jsd.handler(s3_event("FSD-1/good", "FSD-1/bad"), None)
+    assert calls == [["good", "bad"], ["good"], ["bad"]]
+    assert store.deleted == ["FSD-1/good"]
+    assert len(completed(store)) == 1
+
+
+def test_s3_to_jsd_does_not_resend_after_server_error(store, monkeypatch):
+    calls = []
+
+    def unavailable(desk, files):
+        calls.append(len(files))
+        raise http_error(503)
+    monkeypatch.setattr(jsd, "attach_temporary_files", unavailable)
+    with pytest.raises(s3.ObjectsLeft):
+        s3_to_jsd.handler(s3_event("FSD-1/file-0", "FSD-1/file-1"), None)
+    assert calls == [2]
+
+
+def test_s3_to_snow_sends_files_one_by_one_when_rejected(store, monkeypatch):
+    calls = []
+
+    def upload(session, customer_ref, attachments):
+        calls.append([file_name for file_name, _, _ in attachments])
+        if any(file_name == "bad" for file_name, _, _ in attachments):
+            raise snow.ClientError("Bad request", http_error(400).response)
+    monkeypatch.setattr(s3_to_snow, "upload_files_to_snow", upload)
+    with pytest.raises(s3.ObjectsLeft):
+        s3_to_snow.handler(s3_event("INC1/1/good", "INC1/2/bad"), None)
+    assert calls == [["good", "bad"], ["good"], ["bad"]]
+    assert store.deleted == ["INC1/1/good"]
+    assert len(completed(store)) == 1
+
+
+def test_s3_to_snow_does_not_resend_after_server_error(store, monkeypatch):
+    calls = []
+
+    def unavailable(session, customer_ref, attachments):
+        calls.append(len(attachments))
+        raise http_error(503)
+    monkeypatch.setattr(s3_to_snow, "upload_files_to_snow", unavailable)
+    with pytest.raises(s3.ObjectsLeft):
+        s3_to_snow.handler(s3_event("INC1/1/file-0", "INC1/2/file-1"), None)
+    assert calls == [2]
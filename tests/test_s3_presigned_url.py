@@ -0,0 +1,14 @@
+import pytest
+import s3_presigned_url
+
+
+@pytest.mark.parametrize("file_names", [
+    "file.txt", [{"a": 1}], [["file.txt"]], [1], [""], ["file.txt", "file.txt"],
+])
+def test_invalid_file_names_are_rejected(file_names):
+    status, resp = s3_presigned_url.generate_presigned_urls("FSD-1", file_names, 60)
+    assert status == 400
+    assert resp == {
+        "ok": False,
+        "error": "`file_names` must be a list of distinct, non-empty file names",
+    }